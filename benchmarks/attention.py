@@ -0,0 +1,66 @@
+"""
+Compares the per-head MultiHeadAttention with FusedMultiHeadAttention loaded
+from the same weights, checking that both produce the same output.
+
+Run from the repository root:
+    python -m benchmarks.attention
+"""
+import argparse
+
+import torch
+
+from src.model.transformer import FusedMultiHeadAttention, MultiHeadAttention
+from src.utils.timer import TimerContextManager
+
+CONFIGS = {
+    "9M": dict(n_embed=128, n_head=8, batch_size=16, block_size=32),
+    "143M": dict(n_embed=256, n_head=16, batch_size=16, block_size=512),
+}
+
+
+def benchmark(name: str, iters: int, device: torch.device) -> None:
+    config = CONFIGS[name]
+    kwargs = dict(
+        num_heads=config["n_head"],
+        head_size=config["n_embed"] // config["n_head"],
+        n_embed=config["n_embed"],
+        block_size=config["block_size"],
+    )
+    layers = {
+        "heads": MultiHeadAttention(**kwargs),
+        "fused": FusedMultiHeadAttention(**kwargs),
+    }
+    layers["fused"].load_state_dict(layers["heads"].state_dict())
+    x = torch.randn(
+        config["batch_size"], config["block_size"], config["n_embed"], device=device
+    )
+
+    with torch.no_grad():
+        for layer in layers.values():
+            layer.to(device).eval()
+        torch.testing.assert_close(
+            layers["fused"](x), layers["heads"](x), rtol=1e-5, atol=1e-5
+        )
+
+        for variant, layer in layers.items():
+            buffer_bytes = sum(b.numel() * b.element_size() for b in layer.buffers())
+            with TimerContextManager(verbose=False) as timer:
+                for _ in range(iters):
+                    layer(x)
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+            print(
+                f"{name} {variant}: {timer.elapsed / iters * 1e3:.2f} ms/layer, "
+                f"{buffer_bytes / 2**20:.2f} MiB of buffers"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS))
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    for name in args.configs:
+        benchmark(name, iters=args.iters, device=torch.device(args.device))
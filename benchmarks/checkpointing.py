@@ -0,0 +1,67 @@
+"""
+Reports the memory vs step time tradeoff of activation checkpointing: the
+activations kept for backward, peak memory and training step time for
+several checkpoint_every settings. Each run gets its own process.
+
+Run from the repository root:
+    python -m benchmarks.checkpointing --configs 9M
+"""
+from typing import Tuple
+
+import torch
+
+from benchmarks.common import (
+    MODEL_CONFIGS,
+    benchmark_parser,
+    run_in_process,
+    time_train_steps,
+    train_setup,
+)
+from src.utils.memory import peak_memory_mb
+
+
+def saved_activation_mb(model: torch.nn.Module, xb: torch.Tensor) -> float:
+    """Size of the distinct tensors autograd keeps for backward of one forward"""
+    storages = {}
+
+    def pack(tensor: torch.Tensor) -> torch.Tensor:
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        _, loss = model(xb, xb)
+    loss.backward()
+    parameters = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    return sum(n for ptr, n in storages.items() if ptr not in parameters) / 2**20
+
+
+def run(
+    name: str, checkpoint_every: int, batch_size: int, iters: int, device: str
+) -> Tuple[float, float, float]:
+    device = torch.device(device)
+    setup = train_setup(
+        MODEL_CONFIGS[name], batch_size, device, checkpoint_every=checkpoint_every
+    )
+    model, _, _, (xb, _) = setup
+    activations = saved_activation_mb(model, xb)
+    step_ms = time_train_steps(setup, iters)
+    return activations, peak_memory_mb(device), step_ms
+
+
+if __name__ == "__main__":
+    parser = benchmark_parser(MODEL_CONFIGS, iters=5, default_configs=["9M", "143M"])
+    parser.add_argument("--checkpoint-every", type=int, nargs="+", default=[0, 4, 2, 1])
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    for name in args.configs:
+        for every in args.checkpoint_every:
+            activations_mb, memory_mb, step_ms = run_in_process(
+                run, name, every, args.batch_size, args.iters, args.device
+            )
+            print(
+                f"{name} checkpoint_every={every}: "
+                f"{activations_mb:.0f} MiB saved activations, "
+                f"peak memory {memory_mb:.0f} MiB, {step_ms:.1f} ms/step"
+            )
@@ -0,0 +1,107 @@
+"""
+Configs and helpers shared by the benchmarks.
+"""
+import argparse
+import multiprocessing
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple, TypeVar
+
+import torch
+
+from src.model.routers import NoisyTopKRouter
+from src.train import get_model, train_step
+from src.utils.timer import TimerContextManager
+
+T = TypeVar("T")
+
+# SparseMoELanguageModel settings of the experiments/ model sizes
+MODEL_CONFIGS = {
+    "9M": dict(n_embed=128, n_head=8, n_layer=8, num_experts=8, block_size=32),
+    "143M": dict(n_embed=256, n_head=16, n_layer=32, num_experts=8, block_size=512),
+    "227M": dict(n_embed=256, n_head=16, n_layer=32, num_experts=16, block_size=512),
+}
+# Shapes of a single MoE layer of the same model sizes
+LAYER_CONFIGS = {
+    "9M": dict(n_embed=128, num_experts=8, top_k=2, batch_size=16, block_size=32),
+    "143M": dict(n_embed=256, num_experts=8, top_k=2, batch_size=16, block_size=512),
+    "227M": dict(n_embed=256, num_experts=16, top_k=2, batch_size=16, block_size=512),
+}
+
+TrainSetup = Tuple[
+    torch.nn.Module,
+    torch.optim.Optimizer,
+    torch.cuda.amp.GradScaler,
+    Tuple[torch.Tensor, torch.Tensor],
+]
+
+
+def benchmark_parser(
+    configs: Dict[str, Any],
+    iters: int,
+    default_configs: Optional[Sequence[str]] = None,
+) -> argparse.ArgumentParser:
+    """A parser with the --configs, --iters and --device every benchmark takes"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        choices=list(configs),
+        default=list(default_configs or configs),
+    )
+    parser.add_argument("--iters", type=int, default=iters)
+    parser.add_argument("--device", default="cpu")
+    return parser
+
+
+def run_in_process(fn: Callable[..., T], *args) -> T:
+    """fn(*args) in a fresh process, so runs do not share their peak memory"""
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def run_seeded(fn: Callable[..., T], seed: int, *args, **kwargs) -> T:
+    # Only training mode samples router noise, eval mode routes on the clean
+    # logits. Reseeding makes training calls with the same seed route alike
+    torch.manual_seed(seed)
+    return fn(*args, **kwargs)
+
+
+def train_setup(
+    config: Dict[str, Any],
+    batch_size: int,
+    device: torch.device,
+    precision: str = "fp32",
+    **model_kwargs,
+) -> TrainSetup:
+    """
+    A NoisyTopKRouter model of config with its optimizer, grad scaler and one
+    random batch to train on
+    """
+    model = get_model(
+        vocab_size=65, router_class=NoisyTopKRouter, **config, **model_kwargs
+    ).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    scaler = torch.cuda.amp.GradScaler(enabled=precision == "fp16")
+    xb, yb = torch.randint(65, (2, batch_size, config["block_size"]), device=device)
+    return model, optimizer, scaler, (xb, yb)
+
+
+def time_train_steps(setup: TrainSetup, iters: int, precision: str = "fp32") -> float:
+    """Mean ms per train_step over iters steps on the batch of setup"""
+    model, optimizer, scaler, (xb, yb) = setup
+    with TimerContextManager(verbose=False) as timer:
+        for _ in range(iters):
+            loss = train_step(model, optimizer, scaler, xb, yb, precision=precision)
+        loss.item()
+    return timer.elapsed / iters * 1e3
+
+
+def time_ms(fn: Callable[[], None], iters: int, device: torch.device) -> float:
+    """Mean ms per call of fn after one warmup call"""
+    fn()  # warmup
+    with TimerContextManager(verbose=False) as timer:
+        for _ in range(iters):
+            fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+    return timer.elapsed / iters * 1e3
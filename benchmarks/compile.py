@@ -0,0 +1,90 @@
+"""
+Compares eager and torch.compile training step time on the configs of the
+experiments/ scripts, both with the static-shape padded MoE dispatch at the
+same expert capacity, and reports the assignments dropped over it. Each run
+gets its own process.
+
+Run from the repository root:
+    python -m benchmarks.compile --configs noisy_top_k_2
+"""
+from typing import Tuple
+
+import torch
+
+from benchmarks.common import (
+    benchmark_parser,
+    run_in_process,
+    time_train_steps,
+    train_setup,
+)
+from src.model.moe import DEFAULT_CAPACITY_FACTOR
+from src.train import train_step
+from src.utils.timer import TimerContextManager
+
+# model settings of every script in experiments/, as passed to train_loop
+CONFIGS = {
+    "noisy_top_k_2": dict(top_k=2, num_experts=8, block_size=32),
+    "noisy_top_k_8": dict(top_k=8, num_experts=8, block_size=32),
+    "noisy_top_k_2_143M": dict(
+        top_k=2, num_experts=8, block_size=512, n_embed=256, n_head=16, n_layer=32
+    ),
+    "noisy_top_k_8_143M": dict(
+        top_k=8, num_experts=8, block_size=512, n_embed=256, n_head=16, n_layer=32
+    ),
+    "noisy_topk_2_16e_143M": dict(
+        top_k=2, num_experts=16, block_size=512, n_embed=256, n_head=16, n_layer=16
+    ),
+    "noisy_top_k_2_16e_227M": dict(
+        top_k=2, num_experts=16, block_size=512, n_embed=256, n_head=16, n_layer=32
+    ),
+}
+
+
+def run(
+    name: str,
+    compile: bool,
+    capacity_factor: float,
+    batch_size: int,
+    iters: int,
+    device: str,
+) -> Tuple[float, float, int]:
+    """
+    Returns the time of the first step, the mean time of the later ones and
+    the assignments dropped in the last step, summed over the layers
+    """
+    setup = train_setup(
+        CONFIGS[name],
+        batch_size,
+        torch.device(device),
+        dispatch="padded",
+        stacked_experts=True,
+        capacity_factor=capacity_factor,
+        compile=compile,
+    )
+    model, optimizer, scaler, (xb, yb) = setup
+    with TimerContextManager(verbose=False) as first_step:
+        train_step(model, optimizer, scaler, xb, yb).item()
+    step_ms = time_train_steps(setup, iters)
+    return first_step.elapsed, step_ms, int(model.dropped_assignments().sum())
+
+
+if __name__ == "__main__":
+    parser = benchmark_parser(CONFIGS, iters=5)
+    parser.add_argument(
+        "--capacity-factor", type=float, default=DEFAULT_CAPACITY_FACTOR
+    )
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    for name in args.configs:
+        for compile in (False, True):
+            run_args = (args.capacity_factor, args.batch_size, args.iters, args.device)
+            first_step_s, step_ms, dropped = run_in_process(
+                run, name, compile, *run_args
+            )
+            mode = "compiled" if compile else "eager"
+            print(
+                f"{name} {mode}: {step_ms:.1f} ms/step "
+                f"(first step {first_step_s:.1f}s), "
+                f"dropped {dropped} assignments"
+            )
@@ -0,0 +1,82 @@
+"""
+Measures how training throughput scales with the number of data parallel
+processes. Every world size gets fresh processes on the gloo backend, each
+rank trains on its own batch_size batches, so the global batch grows with
+the world size.
+
+Run from the repository root:
+    python -m benchmarks.ddp_scaling --world-sizes 1 2 4
+"""
+import argparse
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from benchmarks.common import MODEL_CONFIGS
+from src.model.routers import NoisyTopKRouter
+from src.train import get_model, train_step
+from src.utils.timer import TimerContextManager
+
+
+def run(
+    rank: int,
+    world_size: int,
+    name: str,
+    batch_size: int,
+    iters: int,
+    port: int,
+    results: "mp.Queue",
+) -> None:
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    # ranks share the cores of the host
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    torch.manual_seed(42 + rank)
+
+    config = MODEL_CONFIGS[name]
+    model = get_model(vocab_size=65, router_class=NoisyTopKRouter, **config)
+    model = DistributedDataParallel(model, find_unused_parameters=True)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    scaler = torch.cuda.amp.GradScaler(enabled=False)
+    xb, yb = torch.randint(65, (2, batch_size, config["block_size"]))
+
+    train_step(model, optimizer, scaler, xb, yb)  # warmup
+    dist.barrier()
+    with TimerContextManager(verbose=False) as timer:
+        for _ in range(iters):
+            train_step(model, optimizer, scaler, xb, yb)
+        dist.barrier()
+    if rank == 0:
+        results.put(timer.elapsed / iters)
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", nargs="+", default=["9M"])
+    parser.add_argument("--world-sizes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--port", type=int, default=29512)
+    args = parser.parse_args()
+
+    context = mp.get_context("spawn")
+    for name in args.configs:
+        baseline = None
+        for world_size in args.world_sizes:
+            results = context.Queue()
+            run_args = (world_size, name, args.batch_size, args.iters, args.port)
+            mp.spawn(run, args=(*run_args, results), nprocs=world_size)
+            step_time = results.get()
+            tokens = args.batch_size * MODEL_CONFIGS[name]["block_size"] * world_size
+            tokens_per_sec = tokens / step_time
+            baseline = baseline or tokens_per_sec
+            print(
+                f"{name} world_size={world_size}: {step_time * 1e3:.1f} ms/step, "
+                f"{tokens_per_sec:.0f} tokens/sec, "
+                f"{tokens_per_sec / baseline:.2f}x of one process"
+            )
@@ -0,0 +1,124 @@
+"""
+Checks ExpertParallelSparseMoE against the single-process SparseMoE on gloo
+CPU processes and times its forward and backward. Every rank runs both
+layers on its own tokens in eval mode, where routing samples no noise: the
+outputs, dropped assignments and router gradients must match, and the
+gradient of every expert must match the reference gradients summed over all
+ranks. Both layers use the same --capacity-factor, and the assignments
+dropped over it are reported summed over the ranks.
+
+Run from the repository root:
+    python -m benchmarks.expert_parallel --world-sizes 2 4
+"""
+import argparse
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from benchmarks.common import LAYER_CONFIGS
+from src.model.expert_parallel import ExpertParallelSparseMoE
+from src.model.moe import DEFAULT_CAPACITY_FACTOR, SparseMoE
+from src.model.routers import NoisyTopKRouter
+from src.utils.timer import TimerContextManager
+
+
+def run(
+    rank: int,
+    world_size: int,
+    name: str,
+    stacked_experts: bool,
+    capacity_factor: float,
+    iters: int,
+    port: int,
+) -> None:
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+
+    config = dict(LAYER_CONFIGS[name])
+    batch_size, block_size = config.pop("batch_size"), config.pop("block_size")
+    layers = dict(
+        router_class=NoisyTopKRouter,
+        stacked_experts=stacked_experts,
+        capacity_factor=capacity_factor,
+        **config,
+    )
+    # Same seed on every rank, so all ranks build the same reference weights
+    torch.manual_seed(0)
+    reference = SparseMoE(dispatch="padded", **layers).eval()
+    layer = ExpertParallelSparseMoE(**layers).eval()
+    layer.load_state_dict(reference.state_dict())
+
+    torch.manual_seed(1 + rank)
+    x = torch.randn(batch_size, block_size, config["n_embed"])
+    grad = torch.randn_like(x)
+
+    expected = reference(x)
+    output = layer(x)
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+    assert int(layer.dropped_assignments) == int(reference.dropped_assignments)
+
+    expected.backward(grad)
+    output.backward(grad)
+    torch.testing.assert_close(
+        {key: p.grad for key, p in layer.router.named_parameters()},
+        {key: p.grad for key, p in reference.router.named_parameters()},
+    )
+    expected_grads = {}
+    for key, parameter in reference.experts.named_parameters():
+        dist.all_reduce(parameter.grad)
+        expected_grads[key] = parameter.grad
+    # Bring the summed reference gradients into this rank's expert layout
+    expected_grads = layer.local_experts_state_dict(expected_grads)
+    for key, parameter in layer.experts.named_parameters():
+        torch.testing.assert_close(
+            parameter.grad, expected_grads[key], rtol=1e-4, atol=1e-5
+        )
+
+    dist.barrier()
+    with TimerContextManager(verbose=False) as timer:
+        for _ in range(iters):
+            layer(x).backward(grad)
+        dist.barrier()
+    dropped = layer.dropped_assignments.clone()
+    dist.all_reduce(dropped)
+    if rank == 0:
+        print(
+            f"{name} world_size={world_size}: outputs and gradients match, "
+            f"dropped {int(dropped)} assignments over all ranks, "
+            f"{timer.elapsed / iters * 1e3:.2f} ms/layer forward and backward"
+        )
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--configs", nargs="+", choices=list(LAYER_CONFIGS), default=["9M", "227M"]
+    )
+    parser.add_argument("--world-sizes", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--stacked-experts", action="store_true")
+    parser.add_argument(
+        "--capacity-factor", type=float, default=DEFAULT_CAPACITY_FACTOR
+    )
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--port", type=int, default=29513)
+    args = parser.parse_args()
+
+    for name in args.configs:
+        for world_size in args.world_sizes:
+            mp.spawn(
+                run,
+                args=(
+                    world_size,
+                    name,
+                    args.stacked_experts,
+                    args.capacity_factor,
+                    args.iters,
+                    args.port,
+                ),
+                nprocs=world_size,
+            )
@@ -0,0 +1,67 @@
+"""
+Compares SparseMoELanguageModel.generate with and without the KV cache,
+checking both sample the same tokens and reporting tokens/sec.
+
+Both paths only match because routers skip their noise in eval mode:
+without a cache every past position is routed again at every step.
+
+Run from the repository root:
+    python -m benchmarks.generate
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import MODEL_CONFIGS
+from src.model.routers import NoisyTopKRouter
+from src.model.transformer import SparseMoELanguageModel
+from src.utils.timer import TimerContextManager
+
+
+def benchmark(
+    name: str,
+    batch_size: int,
+    prompt_length: int,
+    max_new_tokens: int,
+    device: torch.device,
+) -> None:
+    config = dict(MODEL_CONFIGS[name])
+    block_size = config["block_size"]
+    model = SparseMoELanguageModel(
+        vocab_size=65, top_k=2, router_class=NoisyTopKRouter, **config
+    )
+    model = model.to(device).eval()
+    prompt = torch.randint(65, (batch_size, prompt_length), device=device)
+
+    samples = {}
+    with torch.no_grad():
+        for use_cache in (False, True):
+            torch.manual_seed(0)
+            with TimerContextManager(verbose=False) as timer:
+                samples[use_cache] = model.generate(
+                    prompt, max_new_tokens, block_size, use_cache=use_cache
+                )
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+            tokens_per_sec = batch_size * max_new_tokens / timer.elapsed
+            print(f"{name} use_cache={use_cache}: {tokens_per_sec:.1f} tokens/sec")
+    assert torch.equal(samples[True], samples[False]), "cached samples differ"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", nargs="+", default=["9M", "143M"])
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--prompt-length", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=24)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    for name in args.configs:
+        benchmark(
+            name,
+            batch_size=args.batch_size,
+            prompt_length=args.prompt_length,
+            max_new_tokens=args.max_new_tokens,
+            device=torch.device(args.device),
+        )
@@ -0,0 +1,69 @@
+"""
+Compares the SparseMoE dispatch modes and expert layouts on the MoE layer
+shapes used in experiments/, checking that all variants without a capacity
+limit produce the same output.
+
+Run from the repository root:
+    python -m benchmarks.moe_dispatch
+"""
+from typing import Dict
+
+import torch
+
+from benchmarks.common import LAYER_CONFIGS, benchmark_parser, time_ms
+from src.model.moe import SparseMoE, unstack_experts_state_dict
+from src.model.routers import NoisyTopKRouter
+
+VARIANTS = {
+    "loop": dict(dispatch="loop"),
+    "sorted": dict(dispatch="sorted"),
+    "padded": dict(dispatch="padded"),
+    "stacked": dict(dispatch="padded", stacked_experts=True),
+    "capacity_1.25": dict(
+        dispatch="padded", stacked_experts=True, capacity_factor=1.25
+    ),
+}
+
+
+def build_layers(config: Dict, device: torch.device) -> Dict[str, SparseMoE]:
+    layers = {
+        name: SparseMoE(router_class=NoisyTopKRouter, **config, **variant)
+        for name, variant in VARIANTS.items()
+    }
+    # Share the reference weights, converting to the stacked layout on load
+    reference = layers["loop"].state_dict()
+    for layer in layers.values():
+        layer.load_state_dict(reference)
+    torch.testing.assert_close(
+        unstack_experts_state_dict(layers["stacked"].state_dict()), reference
+    )
+    return {name: layer.to(device).eval() for name, layer in layers.items()}
+
+
+def benchmark(name: str, iters: int, device: torch.device) -> None:
+    config = dict(LAYER_CONFIGS[name])
+    batch_size, block_size = config.pop("batch_size"), config.pop("block_size")
+    layers = build_layers(config, device)
+    x = torch.randn(batch_size, block_size, config["n_embed"], device=device)
+
+    # The layers are in eval mode, where routing samples no noise
+    with torch.no_grad():
+        reference = layers["loop"](x)
+        for variant, layer in layers.items():
+            output = layer(x)
+            if layer.capacity_factor is None:
+                torch.testing.assert_close(output, reference, rtol=1e-5, atol=1e-5)
+            else:
+                dropped = int(layer.dropped_assignments)
+                print(f"{name} {variant}: dropped {dropped} assignments")
+
+        for variant, layer in layers.items():
+            layer_ms = time_ms(lambda: layer(x), iters, device)
+            print(f"{name} {variant}: {layer_ms:.2f} ms/layer")
+
+
+if __name__ == "__main__":
+    args = benchmark_parser(LAYER_CONFIGS, iters=20).parse_args()
+
+    for name in args.configs:
+        benchmark(name, iters=args.iters, device=torch.device(args.device))
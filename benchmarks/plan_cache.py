@@ -0,0 +1,89 @@
+"""
+Scores the same batches of prompts repeatedly, as few-shot evaluation and
+perplexity sweeps do, with and without SparseMoELanguageModel's dispatch
+plan cache, checking that both give the same losses.
+
+Run from the repository root:
+    python -m benchmarks.plan_cache --dispatch sorted padded
+"""
+import argparse
+from typing import List
+
+import torch
+
+from benchmarks.common import MODEL_CONFIGS
+from src.model.routers import NoisyTopKRouter
+from src.model.transformer import SparseMoELanguageModel
+from src.utils.timer import TimerContextManager
+
+
+def score(model: SparseMoELanguageModel, batches: List[torch.Tensor]) -> torch.Tensor:
+    # the batch index names the batch for the plan cache
+    return torch.stack(
+        [model(batch, batch, plan_id=i)[1] for i, batch in enumerate(batches)]
+    )
+
+
+def benchmark(
+    name: str,
+    dispatch: str,
+    num_batches: int,
+    batch_size: int,
+    repeats: int,
+    device: torch.device,
+) -> None:
+    config = MODEL_CONFIGS[name]
+    model = SparseMoELanguageModel(
+        vocab_size=65,
+        top_k=2,
+        router_class=NoisyTopKRouter,
+        dispatch=dispatch,
+        **config,
+    )
+    model = model.to(device).eval()
+    batches = [
+        torch.randint(65, (batch_size, config["block_size"]), device=device)
+        for _ in range(num_batches)
+    ]
+
+    with torch.inference_mode():
+        expected = score(model, batches)
+        with TimerContextManager(verbose=False) as timer:
+            for _ in range(repeats):
+                score(model, batches).tolist()
+        uncached_ms = timer.elapsed / repeats * 1e3
+
+        with model.dispatch_plan_cache():
+            score(model, batches)  # fills the cache
+            with TimerContextManager(verbose=False) as timer:
+                for _ in range(repeats):
+                    losses = score(model, batches)
+                    losses.tolist()
+        cached_ms = timer.elapsed / repeats * 1e3
+    torch.testing.assert_close(losses, expected)
+    print(
+        f"{name} {dispatch}: {uncached_ms:.1f} ms uncached, "
+        f"{cached_ms:.1f} ms cached per pass over {num_batches} batches"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", nargs="+", default=["9M"])
+    parser.add_argument("--dispatch", nargs="+", default=["loop", "sorted", "padded"])
+    parser.add_argument("--num-batches", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    for name in args.configs:
+        for dispatch in args.dispatch:
+            benchmark(
+                name,
+                dispatch,
+                num_batches=args.num_batches,
+                batch_size=args.batch_size,
+                repeats=args.repeats,
+                device=torch.device(args.device),
+            )
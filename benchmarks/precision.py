@@ -0,0 +1,48 @@
+"""
+Compares training step time and peak memory of every train_loop precision.
+Each run gets its own process, so peak memory is not shared between runs.
+
+Run from the repository root:
+    python -m benchmarks.precision --configs 9M
+"""
+from typing import Tuple
+
+import torch
+
+from benchmarks.common import (
+    MODEL_CONFIGS,
+    benchmark_parser,
+    run_in_process,
+    time_train_steps,
+    train_setup,
+)
+from src.train import train_step
+from src.utils.memory import peak_memory_mb
+
+
+def run(
+    name: str, precision: str, batch_size: int, iters: int, device: str
+) -> Tuple[float, float]:
+    device = torch.device(device)
+    setup = train_setup(MODEL_CONFIGS[name], batch_size, device, precision=precision)
+    model, optimizer, scaler, (xb, yb) = setup
+    train_step(model, optimizer, scaler, xb, yb, precision=precision)  # warmup
+    step_ms = time_train_steps(setup, iters, precision=precision)
+    return step_ms, peak_memory_mb(device)
+
+
+if __name__ == "__main__":
+    parser = benchmark_parser(MODEL_CONFIGS, iters=5)
+    parser.add_argument("--precisions", nargs="+", default=["fp32", "bf16"])
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    for name in args.configs:
+        for precision in args.precisions:
+            step_ms, memory_mb = run_in_process(
+                run, name, precision, args.batch_size, args.iters, args.device
+            )
+            print(
+                f"{name} {precision}: {step_ms:.1f} ms/step, "
+                f"peak memory {memory_mb:.0f} MiB"
+            )
@@ -0,0 +1,123 @@
+"""
+Evaluates int8 weight-only quantization of a SparseMoELanguageModel on CPU:
+the validation perplexity on the shakespeare val split, the size of the
+saved weights and generation tokens/sec, in fp32 and after quantize_model.
+The quantized model goes through save_quantized and load_quantized, so the
+saved format is checked too.
+
+Pass the weights of a trained model with --checkpoint, a checkpoint_path
+file or a CheckpointManager checkpoint or directory of train_loop, built
+with the same config. Without one the model is randomly initialized, so
+only the speedup is meaningful.
+
+Run from the repository root:
+    python -m benchmarks.quantization --checkpoint checkpoints/moe_9M
+"""
+import argparse
+import copy
+import math
+import os
+import tempfile
+from typing import Optional
+
+import torch
+
+from benchmarks.common import MODEL_CONFIGS
+from src.data.loader import Loader
+from src.data.tokenizer import Tokenizer
+from src.model.quantization import load_quantized, quantize_model, save_quantized
+from src.model.routers import ROUTERS
+from src.model.transformer import SparseMoELanguageModel
+from src.train import evaluate, get_model
+from src.utils.checkpoint import latest_checkpoint
+from src.utils.timer import TimerContextManager
+
+
+def tokens_per_sec(
+    model: SparseMoELanguageModel,
+    prompt: torch.Tensor,
+    max_new_tokens: int,
+    block_size: int,
+) -> float:
+    torch.manual_seed(0)
+    # evaluate leaves the model in training mode
+    model.eval()
+    with torch.no_grad(), TimerContextManager(verbose=False) as timer:
+        model.generate(prompt, max_new_tokens, block_size, use_cache=True)
+    return prompt.size(0) * max_new_tokens / timer.elapsed
+
+
+def benchmark(
+    name: str,
+    router: str,
+    checkpoint: Optional[str],
+    eval_samples: int,
+    batch_size: int,
+    prompt_length: int,
+    max_new_tokens: int,
+) -> None:
+    config = dict(MODEL_CONFIGS[name])
+    block_size = config["block_size"]
+    tokenizer = Tokenizer()
+    model = get_model(
+        vocab_size=tokenizer.vocab_size,
+        router_class=ROUTERS[router],  # type: ignore
+        **config,
+    ).eval()
+    if checkpoint is not None:
+        path = latest_checkpoint(checkpoint)
+        assert path is not None, f"no checkpoint found in {checkpoint}"
+        state = torch.load(path, map_location="cpu")
+        # CheckpointManager checkpoints keep the weights under "model"
+        model.load_state_dict(state.get("model", state))
+
+    val_set = Loader(tokenizer).sample_eval_set("val", eval_samples, block_size)
+    prompt = torch.randint(tokenizer.vocab_size, (batch_size, prompt_length))
+
+    with tempfile.TemporaryDirectory() as directory:
+        fp32_path = os.path.join(directory, "fp32.pt")
+        int8_path = os.path.join(directory, "int8.pt")
+        torch.save(model.state_dict(), fp32_path)
+        save_quantized(quantize_model(copy.deepcopy(model)), int8_path)
+        quantized = load_quantized(copy.deepcopy(model), int8_path)
+        sizes = [os.path.getsize(p) / 2**20 for p in (fp32_path, int8_path)]
+
+    results = []
+    for label, m in (("fp32", model), ("int8", quantized)):
+        loss = evaluate(m, {"val": val_set}, batch_size=batch_size)["val"]
+        speed = tokens_per_sec(m, prompt, max_new_tokens, block_size)
+        results.append((math.exp(loss), speed))
+        print(
+            f"{name} {label}: val perplexity {math.exp(loss):.4f}, "
+            f"{speed:.1f} tokens/sec"
+        )
+    (fp32_ppl, fp32_speed), (int8_ppl, int8_speed) = results
+    print(
+        f"{name}: perplexity delta {int8_ppl - fp32_ppl:+.4f} "
+        f"({(int8_ppl / fp32_ppl - 1) * 100:+.2f}%), "
+        f"{int8_speed / fp32_speed:.2f}x generation speedup, "
+        f"weights {sizes[0]:.1f} MB -> {sizes[1]:.1f} MB"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", nargs="+", default=["9M"])
+    parser.add_argument("--router", default="noisy_top_k", choices=list(ROUTERS))
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--eval-samples", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--prompt-length", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=24)
+    args = parser.parse_args()
+
+    for name in args.configs:
+        benchmark(
+            name,
+            router=args.router,
+            checkpoint=args.checkpoint,
+            eval_samples=args.eval_samples,
+            batch_size=args.batch_size,
+            prompt_length=args.prompt_length,
+            max_new_tokens=args.max_new_tokens,
+        )
@@ -0,0 +1,82 @@
+"""
+Compares the Router implementations on the MoE layer shapes used in
+experiments/, at 8 and 16 experts: the router alone, and the forward and
+the forward and backward of a SparseMoE layer using it. FusedTopKRouter
+loads the NoisyTopKRouter weights, so both must pick the same experts with
+the same weights under the same noise.
+
+Run from the repository root:
+    python -m benchmarks.routers
+"""
+from typing import Dict
+
+import torch
+
+from benchmarks.common import LAYER_CONFIGS, benchmark_parser, run_seeded, time_ms
+from src.model.moe import Router, SparseMoE
+from src.model.routers import ROUTERS
+
+
+def route(router: Router, x: torch.Tensor, token_ids: torch.Tensor):
+    if router.requires_token_ids:
+        return router(x, token_ids)
+    return router(x)
+
+
+def top_k_weights(
+    router: Router, x: torch.Tensor, token_ids: torch.Tensor, seed: int
+) -> torch.Tensor:
+    gating_output, indices, _ = run_seeded(route, seed, router, x, token_ids)
+    if router.output_format == "dense":
+        gating_output = gating_output.gather(-1, indices)
+    return torch.stack([gating_output, indices.to(gating_output.dtype)])
+
+
+def benchmark(name: str, iters: int, device: torch.device) -> None:
+    config = dict(LAYER_CONFIGS[name])
+    batch_size, block_size = config.pop("batch_size"), config.pop("block_size")
+    layers: Dict[str, SparseMoE] = {
+        router: SparseMoE(
+            router_class=router_class,
+            dispatch="padded",
+            stacked_experts=True,
+            **config,
+        )
+        for router, router_class in ROUTERS.items()
+    }
+    # Same experts everywhere, and the fused router fuses the noisy one
+    reference = layers["noisy_top_k"].state_dict()
+    layers["fused_top_k"].load_state_dict(reference)
+    experts = {k: v for k, v in reference.items() if k.startswith("experts.")}
+    # Timed in training mode, where the routers sample their noise
+    for layer in layers.values():
+        layer.load_state_dict(experts, strict=False)
+        layer.to(device)
+    x = torch.randn(batch_size, block_size, config["n_embed"], device=device)
+    token_ids = torch.randint(65, (batch_size, block_size), device=device)
+
+    with torch.no_grad():
+        torch.testing.assert_close(
+            top_k_weights(layers["fused_top_k"].router, x, token_ids, seed=0),
+            top_k_weights(layers["noisy_top_k"].router, x, token_ids, seed=0),
+        )
+
+    for router, layer in layers.items():
+        with torch.no_grad():
+            router_ms = time_ms(
+                lambda: route(layer.router, x, token_ids), iters, device
+            )
+            forward_ms = time_ms(lambda: layer(x, token_ids), iters, device)
+        train_ms = time_ms(lambda: layer(x, token_ids).sum().backward(), iters, device)
+        print(
+            f"{name} {router}: {router_ms:.3f} ms/router, "
+            f"{forward_ms:.2f} ms/layer forward, "
+            f"{train_ms:.2f} ms/layer forward and backward"
+        )
+
+
+if __name__ == "__main__":
+    args = benchmark_parser(LAYER_CONFIGS, iters=50).parse_args()
+
+    for name in args.configs:
+        benchmark(name, iters=args.iters, device=torch.device(args.device))
@@ -0,0 +1,70 @@
+"""
+Serves a queue of random variable-length prompts with GenerationEngine and
+reports throughput and per-request latency.
+
+Run from the repository root:
+    python -m benchmarks.serve
+"""
+import argparse
+import random
+import statistics
+
+import torch
+
+from benchmarks.common import MODEL_CONFIGS
+from src.inference.engine import GenerationEngine, GenerationRequest
+from src.model.routers import NoisyTopKRouter
+from src.model.transformer import SparseMoELanguageModel
+
+
+def benchmark(
+    name: str, num_requests: int, max_batch_size: int, device: torch.device
+) -> None:
+    config = MODEL_CONFIGS[name]
+    block_size = config["block_size"]
+    model = SparseMoELanguageModel(
+        vocab_size=65, top_k=2, router_class=NoisyTopKRouter, **config
+    ).to(device)
+    engine = GenerationEngine(model, block_size, max_batch_size=max_batch_size)
+
+    rng = random.Random(0)
+    for _ in range(num_requests):
+        prompt_length = rng.randint(1, block_size // 2)
+        engine.submit(
+            GenerationRequest(
+                prompt=[rng.randrange(65) for _ in range(prompt_length)],
+                max_new_tokens=rng.randint(1, block_size // 2),
+                temperature=rng.choice([0.7, 1.0]),
+                top_k=rng.choice([None, 10]),
+                top_p=rng.choice([None, 0.9]),
+            )
+        )
+
+    report = engine.run()
+    latencies = [r.latency * 1e3 for r in report.results]
+    first_token = [r.time_to_first_token * 1e3 for r in report.results]
+    print(
+        f"{name} max_batch_size={max_batch_size}: "
+        f"{report.tokens_per_sec:.1f} tokens/sec, "
+        f"latency p50 {statistics.median(latencies):.1f} ms "
+        f"max {max(latencies):.1f} ms, "
+        f"time to first token p50 {statistics.median(first_token):.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", nargs="+", default=["9M", "143M"])
+    parser.add_argument("--num-requests", type=int, default=32)
+    parser.add_argument("--max-batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    for name in args.configs:
+        for max_batch_size in args.max_batch_sizes:
+            benchmark(
+                name,
+                num_requests=args.num_requests,
+                max_batch_size=max_batch_size,
+                device=torch.device(args.device),
+            )
@@ -0,0 +1,44 @@
+"""
+Compares Tokenizer and FastTokenizer encode/decode throughput on the
+shakespeare corpus repeated to a larger size.
+
+Run from the repository root:
+    python -m benchmarks.tokenizer
+"""
+import argparse
+
+import numpy as np
+
+from src.data.loader import DATA_FILE
+from src.data.tokenizer import FastTokenizer, Tokenizer
+from src.utils.timer import TimerContextManager
+
+
+def benchmark(repeats: int) -> None:
+    with open(DATA_FILE, "r", encoding="utf-8") as f:
+        text = f.read() * repeats
+    megabytes = len(text.encode("utf-8")) / 2**20
+
+    reference = None
+    for tokenizer in (Tokenizer(), FastTokenizer()):
+        name = type(tokenizer).__name__
+        with TimerContextManager(verbose=False) as encode_timer:
+            tokens = tokenizer.encode(text)
+        with TimerContextManager(verbose=False) as decode_timer:
+            decoded = tokenizer.decode(tokens)
+        assert decoded == text, f"{name} does not round trip"
+        print(
+            f"{name}: encode {megabytes / encode_timer.elapsed:.1f} MB/s, "
+            f"decode {megabytes / decode_timer.elapsed:.1f} MB/s"
+        )
+        # every corpus character is in the vocabulary, so the ids agree
+        if reference is None:
+            reference = np.asarray(tokens)
+        assert np.array_equal(np.asarray(tokens), reference), f"{name} ids differ"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+    benchmark(args.repeats)
@@ -0,0 +1,10 @@
+from src.train import train_loop
+
+train_loop(
+    experiment_group="expert_choice",
+    experiment_name="expert_choice_2_9m",
+    max_iters=10000,
+    eval_interval=100,
+    router="expert_choice",
+    dispatch="sorted",
+)
@@ -0,0 +1,10 @@
+from src.train import train_loop
+
+train_loop(
+    experiment_group="hash",
+    experiment_name="hash_2_9m",
+    max_iters=10000,
+    eval_interval=100,
+    router="hash",
+    dispatch="sorted",
+)
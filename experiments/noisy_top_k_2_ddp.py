@@ -0,0 +1,13 @@
+from src.train import train_loop
+
+# torchrun --nproc_per_node=4 -m experiments.noisy_top_k_2_ddp
+train_loop(
+    experiment_group="noisy_topk",
+    experiment_name="noisy_topk_2_9m_ddp",
+    max_iters=10000,
+    eval_interval=100,
+    distributed=True,
+    backend="gloo",
+    checkpoint_path="noisy_topk_2_9m_ddp.pt",
+    device="cpu",
+)
@@ -0,0 +1,168 @@
+"""
+Byte-pair encoding tokenizer over UTF-8 bytes, an alternative to the character
+Tokenizer that makes sequences several times shorter.
+
+Train one on a corpus and save it from the repository root with:
+    python -m src.data.bpe --vocab-size 512 --output data/bpe_512.json
+"""
+import argparse
+import heapq
+import json
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Set, Tuple
+
+# Merges never cross the boundaries of these chunks: words with their leading
+# space, runs of digits or punctuation, and whitespace
+PRETOKENIZE_PATTERN = r" ?[A-Za-z]+| ?[0-9]+| ?[^\sA-Za-z0-9]+|\s+(?!\S)|\s+"
+
+Pair = Tuple[int, int]
+
+
+class BPETokenizer:
+    def __init__(self, merges: List[Pair], pattern: str = PRETOKENIZE_PATTERN) -> None:
+        # Token 256 + rank is the merge of the pair at merges[rank]
+        self.merges = [tuple(pair) for pair in merges]
+        self.ranks: Dict[Pair, int] = {pair: i for i, pair in enumerate(self.merges)}
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+
+        self.vocab = [bytes([i]) for i in range(256)]
+        for a, b in self.merges:
+            self.vocab.append(self.vocab[a] + self.vocab[b])
+        self.vocab_size = len(self.vocab)
+
+        # Most text is made of a small set of words, so cache their encodings
+        self._encode_chunk = lru_cache(maxsize=1 << 16)(self._merge_chunk)
+
+    def encode(self, string: str) -> List[int]:
+        tokens = []
+        for chunk in self.regex.findall(string):
+            tokens.extend(self._encode_chunk(chunk.encode("utf-8")))
+        return tokens
+
+    def decode(self, tokens: Iterable[int]) -> str:
+        data = b"".join(self.vocab[int(token)] for token in tokens)
+        return data.decode("utf-8", errors="replace")
+
+    def _merge_chunk(self, chunk: bytes) -> Tuple[int, ...]:
+        """
+        Applies the merges to one chunk, always the lowest ranked pair first,
+        with a heap of candidate pairs over a linked list of symbols
+        """
+        ids = list(chunk)
+        n = len(ids)
+        prev = list(range(-1, n - 1))
+        following = list(range(1, n + 1))  # n marks the end of the chunk
+        alive = [True] * n
+
+        heap = []
+        for i in range(n - 1):
+            rank = self.ranks.get((ids[i], ids[i + 1]))
+            if rank is not None:
+                heap.append((rank, i))
+        heapq.heapify(heap)
+
+        while heap:
+            rank, i = heapq.heappop(heap)
+            j = following[i]
+            # skip entries made stale by an earlier merge around i
+            if not alive[i] or j == n or self.ranks.get((ids[i], ids[j])) != rank:
+                continue
+            ids[i] = 256 + rank
+            alive[j] = False
+            following[i] = following[j]
+            if following[j] < n:
+                prev[following[j]] = i
+            for left, right in ((prev[i], i), (i, following[i])):
+                if left >= 0 and right < n:
+                    new_rank = self.ranks.get((ids[left], ids[right]))
+                    if new_rank is not None:
+                        heapq.heappush(heap, (new_rank, left))
+        return tuple(ids[i] for i in range(n) if alive[i])
+
+    @classmethod
+    def train(
+        cls, text: str, vocab_size: int, pattern: str = PRETOKENIZE_PATTERN
+    ) -> "BPETokenizer":
+        """
+        Learns vocab_size - 256 merges, each time merging the most frequent
+        adjacent pair across the distinct chunks of text
+        """
+        assert vocab_size >= 256, f"{vocab_size=} must cover the 256 bytes"
+        chunk_counts = Counter(re.findall(pattern, text))
+        words = [list(chunk.encode("utf-8")) for chunk in chunk_counts]
+        counts = list(chunk_counts.values())
+
+        pair_counts: Dict[Pair, int] = defaultdict(int)
+        pair_words: Dict[Pair, Set[int]] = defaultdict(set)
+        for w, word in enumerate(words):
+            for pair in zip(word, word[1:]):
+                pair_counts[pair] += counts[w]
+                pair_words[pair].add(w)
+        # max-heap of pair counts, entries are stale once the count changed
+        heap = [(-count, pair) for pair, count in pair_counts.items()]
+        heapq.heapify(heap)
+
+        merges: List[Pair] = []
+        while len(merges) < vocab_size - 256 and heap:
+            count, pair = heapq.heappop(heap)
+            if -count != pair_counts.get(pair, 0) or count == 0:
+                continue
+            new_id = 256 + len(merges)
+            merges.append(pair)
+
+            changed = set()
+            for w in pair_words.pop(pair):
+                word = words[w]
+                for old in zip(word, word[1:]):
+                    pair_counts[old] -= counts[w]
+                    changed.add(old)
+                merged, i = [], 0
+                while i < len(word):
+                    if i + 1 < len(word) and (word[i], word[i + 1]) == pair:
+                        merged.append(new_id)
+                        i += 2
+                    else:
+                        merged.append(word[i])
+                        i += 1
+                words[w] = merged
+                for new in zip(merged, merged[1:]):
+                    pair_counts[new] += counts[w]
+                    pair_words[new].add(w)
+                    changed.add(new)
+
+            for changed_pair in changed:
+                if pair_counts[changed_pair] > 0:
+                    heapq.heappush(heap, (-pair_counts[changed_pair], changed_pair))
+                else:
+                    del pair_counts[changed_pair]
+        return cls(merges, pattern)
+
+    def save(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"pattern": self.pattern, "merges": self.merges}, f)
+
+    @classmethod
+    def load(cls, path: str) -> "BPETokenizer":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["merges"], data["pattern"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-file", default="data/shakespeare.txt")
+    parser.add_argument("--vocab-size", type=int, default=512)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    with open(args.data_file, "r", encoding="utf-8") as f:
+        text = f.read()
+    tokenizer = BPETokenizer.train(text, args.vocab_size)
+    tokenizer.save(args.output)
+    ratio = len(text) / len(tokenizer.encode(text))
+    print(
+        f"saved {tokenizer.vocab_size} tokens to {args.output}, {ratio:.2f} chars/token"
+    )
@@ -1,28 +1,92 @@
-from typing import Tuple
+import json
+from typing import Dict, Optional, Tuple, Union
 
+import numpy as np
 import torch
 
+from src.data.bpe import BPETokenizer
 from src.data.tokenizer import Tokenizer
 
 DATA_FILE = "data/shakespeare.txt"
 
 
+def meta_file(shard_file: str) -> str:
+    return shard_file.rsplit(".", 1)[0] + ".meta.json"
+
+
+def read_meta(shard_file: str) -> Dict:
+    with open(meta_file(shard_file), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
 class Loader:
-    def __init__(self, tokenizer: Tokenizer, train_split_size: float = 0.9) -> None:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            text = f.read()
-        data = torch.tensor(tokenizer.encode(text), dtype=torch.long)
+    """
+    Samples batches from the tokenized corpus. By default the corpus is read and
+    encoded in memory; given a shard_file written by src.data.prepare, the
+    tokens are memory-mapped instead, so only the sampled pages are ever read.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Union[Tokenizer, BPETokenizer],
+        train_split_size: float = 0.9,
+        shard_file: Optional[str] = None,
+    ) -> None:
+        if shard_file is None:
+            with open(DATA_FILE, "r", encoding="utf-8") as f:
+                text = f.read()
+            data = torch.tensor(tokenizer.encode(text), dtype=torch.long)
+        else:
+            meta = read_meta(shard_file)
+            assert (
+                meta["vocab_size"] == tokenizer.vocab_size
+            ), f"{shard_file} was written with a different tokenizer: {meta=}"
+            data = np.memmap(
+                shard_file, dtype=meta["dtype"], mode="r", shape=(meta["num_tokens"],)
+            )
         train_data_size = int(train_split_size * len(data))
 
         self.train_data = data[:train_data_size]
         self.val_data = data[train_data_size:]
 
     def get_batch(
-        self, split: str, batch_size: int, block_size: int
+        self,
+        split: str,
+        batch_size: int,
+        block_size: int,
+        device: Optional[torch.device] = None,
+        generator: Optional[torch.Generator] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         # generate a small batch of data of inputs x and targets y
         data = self.train_data if split == "train" else self.val_data
-        ix = torch.randint(len(data) - block_size, (batch_size,))
-        x = torch.stack([data[i : i + block_size] for i in ix])
-        y = torch.stack([data[i + 1 : i + block_size + 1] for i in ix])
-        return x, y
+        ix = torch.randint(len(data) - block_size, (batch_size,), generator=generator)
+
+        # Gather block_size + 1 tokens per row at once; x and y are views of it
+        index = ix.unsqueeze(1) + torch.arange(block_size + 1)
+        if isinstance(data, np.memmap):
+            batch = torch.from_numpy(data[index.numpy()].astype(np.int64))
+        else:
+            batch = data[index]
+
+        if device is not None and torch.device(device).type == "cuda":
+            batch = batch.pin_memory().to(device, non_blocking=True)
+        elif device is not None:
+            batch = batch.to(device)
+        return batch[:, :-1], batch[:, 1:]
+
+    def sample_eval_set(
+        self,
+        split: str,
+        num_samples: int,
+        block_size: int,
+        device: Optional[torch.device] = None,
+        seed: int = 1337,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        num_samples windows of a split drawn once from a fixed seed, so every
+        evaluation and every run with the same arguments sees the same tokens
+        """
+        generator = torch.Generator().manual_seed(seed)
+        return self.get_batch(
+            split, num_samples, block_size, device=device, generator=generator
+        )
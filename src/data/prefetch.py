@@ -0,0 +1,100 @@
+import queue
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import torch
+
+from src.data.loader import Loader
+
+
+class BatchPrefetcher:
+    """
+    Samples batches of one split from a Loader on a background thread and keeps
+    up to num_prefetch of them ready, already moved to the device, so the
+    training step does not wait on sampling and host-to-device copies.
+
+    Batches come from the prefetcher's own seeded generator, so the sequence of
+    batches does not depend on what else draws from the global RNG. state_dict
+    holds the generator state after the last consumed batch, passing it back
+    as generator_state continues the same sequence of batches.
+    """
+
+    def __init__(
+        self,
+        loader: Loader,
+        split: str,
+        batch_size: int,
+        block_size: int,
+        device: Optional[torch.device] = None,
+        num_prefetch: int = 2,
+        seed: int = 42,
+        generator_state: Optional[torch.Tensor] = None,
+    ) -> None:
+        self.loader = loader
+        self.split = split
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.device = device
+        self.generator = torch.Generator().manual_seed(seed)
+        if generator_state is not None:
+            self.generator.set_state(generator_state)
+        # Generator state the next unconsumed batch was sampled from
+        self._resume_state = self.generator.get_state()
+
+        # Seconds the consumer spent blocked on the last and on all batches
+        self.last_wait_time = 0.0
+        self.total_wait_time = 0.0
+
+        self._queue: queue.Queue = queue.Queue(maxsize=num_prefetch)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self) -> None:
+        while not self._stop.is_set():
+            try:
+                item = self.loader.get_batch(
+                    self.split,
+                    self.batch_size,
+                    self.block_size,
+                    device=self.device,
+                    generator=self.generator,
+                )
+            except Exception as e:  # re-raised by the consumer
+                item = e
+            state = self.generator.get_state()
+            while not self._stop.is_set():
+                try:
+                    self._queue.put((item, state), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(item, Exception):
+                return
+
+    def __iter__(self) -> "BatchPrefetcher":
+        return self
+
+    def __next__(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        start = time.perf_counter()
+        item, state = self._queue.get()
+        self.last_wait_time = time.perf_counter() - start
+        self.total_wait_time += self.last_wait_time
+        if isinstance(item, Exception):
+            raise item
+        self._resume_state = state
+        return item
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        return {"generator_state": self._resume_state}
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self) -> "BatchPrefetcher":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
@@ -0,0 +1,81 @@
+"""
+Tokenizes a text corpus once into a compact binary shard that Loader can
+memory-map instead of reading and encoding the corpus on every start.
+
+Run from the repository root:
+    python -m src.data.prepare
+"""
+import argparse
+import json
+from typing import Dict, Iterator, Union
+
+import numpy as np
+
+from src.data.bpe import BPETokenizer
+from src.data.loader import DATA_FILE, meta_file
+from src.data.tokenizer import TOKENIZERS, FastTokenizer, Tokenizer
+
+SHARD_FILE = "data/shakespeare.bin"
+CHUNK_SIZE = 1 << 20  # characters encoded at a time
+
+
+def shard_dtype(vocab_size: int) -> np.dtype:
+    assert vocab_size <= 2**16, f"{vocab_size=} does not fit in uint16"
+    return np.dtype(np.uint8 if vocab_size <= 2**8 else np.uint16)
+
+
+def encode_chunks(
+    tokenizer: Union[Tokenizer, BPETokenizer], data_file: str
+) -> Iterator:
+    if isinstance(tokenizer, FastTokenizer):
+        yield from tokenizer.encode_file(data_file)
+        return
+    with open(data_file, "r", encoding="utf-8") as f:
+        # finish every chunk at a line break so no word is split across chunks
+        while chunk := f.read(CHUNK_SIZE) + f.readline():
+            yield tokenizer.encode(chunk)
+
+
+def prepare_shard(
+    tokenizer: Union[Tokenizer, BPETokenizer],
+    data_file: str = DATA_FILE,
+    shard_file: str = SHARD_FILE,
+) -> Dict:
+    """
+    Encodes data_file chunk by chunk into shard_file, next to a metadata file
+    recording how to read it back
+    """
+    dtype = shard_dtype(tokenizer.vocab_size)
+    num_tokens = 0
+    with open(shard_file, "wb") as f:
+        for tokens in encode_chunks(tokenizer, data_file):
+            tokens = np.asarray(tokens, dtype=dtype)
+            tokens.tofile(f)
+            num_tokens += len(tokens)
+
+    meta = {
+        "data_file": data_file,
+        "tokenizer": type(tokenizer).__name__,
+        "vocab_size": tokenizer.vocab_size,
+        "dtype": dtype.name,
+        "num_tokens": num_tokens,
+    }
+    with open(meta_file(shard_file), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-file", default=DATA_FILE)
+    parser.add_argument("--shard-file", default=SHARD_FILE)
+    parser.add_argument("--tokenizer", choices=list(TOKENIZERS), default="char")
+    parser.add_argument("--bpe-file", help="BPETokenizer to use instead of --tokenizer")
+    args = parser.parse_args()
+
+    if args.bpe_file is not None:
+        tokenizer = BPETokenizer.load(args.bpe_file)
+    else:
+        tokenizer = TOKENIZERS[args.tokenizer]()
+    meta = prepare_shard(tokenizer, args.data_file, args.shard_file)
+    print(f"wrote {meta['num_tokens']} {meta['dtype']} tokens to {args.shard_file}")
@@ -1,3 +1,10 @@
+from typing import Iterator
+
+import numpy as np
+
+_CONTINUATION = 255  # byte_to_id entry of UTF-8 continuation bytes
+
+
 class Tokenizer:
     def __init__(self) -> None:
         self.char_string = (
@@ -11,3 +18,52 @@ class Tokenizer:
 
         self.encode = lambda string: [stoi[c] for c in string]
         self.decode = lambda tokens: "".join([itos[i] for i in tokens])
+
+
+class FastTokenizer(Tokenizer):
+    """
+    Character Tokenizer that encodes through a 256-entry lookup table over the
+    UTF-8 bytes of the text with numpy, instead of a dict lookup per character.
+
+    Characters outside the vocabulary map to an extra unknown token rather than
+    raising: the lead byte of a multi-byte character maps to it and the
+    continuation bytes are dropped, so every character is still one token.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.unknown_id = len(self.chars)
+        self.vocab_size = len(self.chars) + 1
+
+        self.byte_to_id = np.full(256, self.unknown_id, dtype=np.uint8)
+        self.byte_to_id[0x80:0xC0] = _CONTINUATION
+        for i, ch in enumerate(self.chars):
+            self.byte_to_id[ord(ch)] = i
+        # \x00 is not in the vocabulary, decode swaps it for a replacement char
+        self.id_to_byte = np.frombuffer(
+            "".join(self.chars).encode("ascii") + b"\x00", dtype=np.uint8
+        )
+
+        self.encode = lambda string: self.encode_bytes(string.encode("utf-8"))
+        self.decode = lambda tokens: (
+            self.id_to_byte[np.asarray(tokens)]
+            .tobytes()
+            .decode("ascii")
+            .replace("\x00", "\ufffd")
+        )
+
+    def encode_bytes(self, data: bytes) -> np.ndarray:
+        ids = self.byte_to_id[np.frombuffer(data, dtype=np.uint8)]
+        return ids[ids != _CONTINUATION]
+
+    def encode_file(self, path: str, chunk_size: int = 1 << 24) -> Iterator[np.ndarray]:
+        """Streams the tokens of a UTF-8 file, chunk_size bytes at a time"""
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield self.encode_bytes(chunk)
+
+
+# Character tokenizers train_loop and src.data.prepare select by name. Their
+# vocabularies differ, FastTokenizer has an extra unknown token, so a shard
+# only loads with the tokenizer it was prepared with
+TOKENIZERS = {"char": Tokenizer, "fast": FastTokenizer}
@@ -0,0 +1,220 @@
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, List, NamedTuple, Optional
+
+import torch
+import torch.nn.functional as F
+
+from src.model.transformer import SparseMoELanguageModel
+
+
+@dataclass
+class GenerationRequest:
+    """
+    A prompt to complete. top_k=None and top_p=None disable that filter.
+    """
+
+    prompt: List[int]
+    max_new_tokens: int
+    temperature: float = 1.0
+    top_k: Optional[int] = None
+    top_p: Optional[float] = None
+
+
+@dataclass
+class GenerationResult:
+    request_id: int
+    tokens: List[int]  # generated tokens, without the prompt
+    latency: float  # seconds from submission to the last token
+    time_to_first_token: float  # seconds from submission to the first token
+
+
+class GenerationReport(NamedTuple):
+    results: List[GenerationResult]
+    tokens_per_sec: float
+
+
+@dataclass
+class _Sequence:
+    request_id: int
+    request: GenerationRequest
+    prompt: List[int]  # the latest block_size tokens of the request's prompt
+    submitted_at: float
+    tokens: List[int] = field(default_factory=list)
+    first_token_at: float = 0.0
+
+
+def sample_next_tokens(
+    logits: torch.Tensor,
+    temperature: torch.Tensor,
+    top_k: torch.Tensor,
+    top_p: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Samples one token per row of logits (B, vocab_size) with per-row
+    temperature, top-k and nucleus (top-p) filtering, all of shape (B,)
+    """
+    logits = logits / temperature.clamp_min(1e-5).unsqueeze(1)
+    sorted_logits, sorted_tokens = logits.sort(dim=-1, descending=True)
+    ranks = torch.arange(logits.size(-1), device=logits.device)
+    removed = ranks >= top_k.unsqueeze(1)
+
+    # Drop every token once the more likely ones already cover top_p
+    probs = F.softmax(sorted_logits.masked_fill(removed, float("-inf")), dim=-1)
+    removed |= probs.cumsum(dim=-1) - probs >= top_p.unsqueeze(1)
+
+    probs = F.softmax(sorted_logits.masked_fill(removed, float("-inf")), dim=-1)
+    choice = torch.multinomial(probs, num_samples=1)
+    return sorted_tokens.gather(-1, choice).squeeze(1)
+
+
+class GenerationEngine:
+    """
+    Serves GenerationRequests with continuous batching: between decode steps,
+    finished sequences leave the batch and queued requests take their place.
+
+    Active sequences occupy the first rows of one shared KVCache. Every new
+    request is prefilled on its own, unpadded: padding would go through MoE
+    routing and compete with real tokens for expert capacity, so a prompt's
+    logits would depend on the prompts admitted with it. A sequence finishes
+    after max_new_tokens or once its context fills block_size.
+
+    Decode steps do batch the newest token of every active sequence through
+    the MoE layers together. With a capacity_factor those tokens compete for
+    expert capacity, and ExpertChoiceRouter picks among them, so a sequence's
+    continuation can depend on the others in the batch. With a token-choice
+    router and no capacity limit, every sequence decodes as it would alone
+    in model.generate.
+    """
+
+    def __init__(
+        self,
+        model: SparseMoELanguageModel,
+        block_size: int,
+        max_batch_size: int = 8,
+    ) -> None:
+        self.model = model.eval()
+        self.block_size = block_size
+        self.max_batch_size = max_batch_size
+        self.kv_cache = model.make_kv_cache(max_batch_size, block_size)
+        self.device = self.kv_cache.keys.device
+
+        self.queue: Deque[_Sequence] = deque()
+        self.active: List[_Sequence] = []  # active[i] lives in cache row i
+        self.next_tokens: List[int] = []  # sampled but not yet fed, per active row
+        self.finished: List[GenerationResult] = []
+        self.num_requests = 0
+        self.num_generated_tokens = 0
+
+    def submit(self, request: GenerationRequest) -> int:
+        assert request.prompt, "Prompts need at least one token"
+        assert request.max_new_tokens > 0, f"{request.max_new_tokens=}"
+        request_id = self.num_requests
+        self.num_requests += 1
+        self.queue.append(
+            _Sequence(
+                request_id=request_id,
+                request=request,
+                prompt=request.prompt[-self.block_size :],
+                submitted_at=time.perf_counter(),
+            )
+        )
+        return request_id
+
+    @torch.no_grad()
+    def step(self) -> List[GenerationResult]:
+        """
+        Admits queued requests into free rows, decodes one token for every
+        active sequence and returns the requests that finished
+        """
+        self._admit()
+        if self.active:
+            num_active = len(self.active)
+            idx = torch.tensor(self.next_tokens, device=self.device).unsqueeze(1)
+            logits, _ = self.model(idx, kv_cache=self.kv_cache.rows(0, num_active))
+            self._append(list(range(num_active)), logits[:, -1, :])
+        finished, self.finished = self.finished, []
+        return finished
+
+    def run(self) -> GenerationReport:
+        """Steps until every submitted request has finished"""
+        start = time.perf_counter()
+        start_tokens = self.num_generated_tokens
+        results = []
+        while self.queue or self.active:
+            results.extend(self.step())
+        elapsed = time.perf_counter() - start
+        tokens_per_sec = (self.num_generated_tokens - start_tokens) / elapsed
+        return GenerationReport(
+            results=sorted(results, key=lambda r: r.request_id),
+            tokens_per_sec=tokens_per_sec,
+        )
+
+    def _admit(self) -> None:
+        start = len(self.active)
+        while self.queue and len(self.active) < self.max_batch_size:
+            self.active.append(self.queue.popleft())
+            self.next_tokens.append(0)
+        if start == len(self.active):
+            return
+
+        rows = list(range(start, len(self.active)))
+        last_logits = []
+        for row in rows:
+            idx = torch.tensor([self.active[row].prompt], device=self.device)
+            kv_cache = self.kv_cache.rows(row, row + 1)
+            kv_cache.lengths.zero_()
+            logits, _ = self.model(idx, kv_cache=kv_cache)
+            last_logits.append(logits[0, -1])
+        self._append(rows, torch.stack(last_logits))
+
+    def _append(self, rows: List[int], logits: torch.Tensor) -> None:
+        # Sample the next token of every sequence in rows from its (vocab_size,)
+        # logits, then retire the sequences that are done
+        requests = [self.active[row].request for row in rows]
+        vocab_size = logits.size(-1)
+        next_tokens = sample_next_tokens(
+            logits,
+            temperature=self._tensor([r.temperature for r in requests]),
+            top_k=self._tensor([r.top_k or vocab_size for r in requests]),
+            top_p=self._tensor([r.top_p or 1.0 for r in requests]),
+        ).tolist()
+
+        now = time.perf_counter()
+        done = []
+        for row, token in zip(rows, next_tokens):
+            sequence = self.active[row]
+            if not sequence.tokens:
+                sequence.first_token_at = now
+            sequence.tokens.append(token)
+            self.next_tokens[row] = token
+            self.num_generated_tokens += 1
+            completed = len(sequence.tokens) == sequence.request.max_new_tokens
+            out_of_context = int(self.kv_cache.lengths[row]) >= self.block_size
+            if completed or out_of_context:
+                done.append(row)
+
+        # Fill every freed row with the last active sequence to keep rows packed
+        for row in sorted(done, reverse=True):
+            sequence = self.active[row]
+            self.finished.append(
+                GenerationResult(
+                    request_id=sequence.request_id,
+                    tokens=sequence.tokens,
+                    latency=now - sequence.submitted_at,
+                    time_to_first_token=(
+                        sequence.first_token_at - sequence.submitted_at
+                    ),
+                )
+            )
+            last = len(self.active) - 1
+            if row != last:
+                self.kv_cache.move_row(last, row)
+                self.active[row] = self.active[last]
+                self.next_tokens[row] = self.next_tokens[last]
+            self.active.pop()
+            self.next_tokens.pop()
+
+    def _tensor(self, values: List[float]) -> torch.Tensor:
+        return torch.tensor(values, device=self.device)
@@ -0,0 +1,129 @@
+import re
+from typing import Dict, Optional
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.distributed.nn.functional import all_to_all_single
+
+from src.model.moe import DEFAULT_CAPACITY_FACTOR, Router, SparseMoE
+
+_EXPERT_INDEX_KEY = re.compile(r"^(?P<index>\d+)\.(?P<rest>.+)$")
+
+
+class ExpertParallelSparseMoE(SparseMoE):
+    """
+    A SparseMoE whose experts are split evenly over the ranks of a process
+    group: rank r holds experts [r * E / world_size, (r + 1) * E / world_size)
+    and the router is replicated. Every rank routes its own tokens into the
+    (num_experts, capacity, n_embed) groups of padded dispatch, an all-to-all
+    sends each group to the rank holding its expert, and a second all-to-all
+    returns the expert outputs.
+
+    Every rank must call forward together with the same number of tokens, so
+    that the capacity, and with it every all-to-all split, is the same. The
+    expert gradients are local to the rank holding them, only the router's
+    need to be averaged over the group.
+
+    The all-to-alls move whole capacity-sized groups, padding included, so
+    capacity_factor defaults to DEFAULT_CAPACITY_FACTOR rather than room for
+    every token. Assignments past capacity are dropped and counted in
+    dropped_assignments, per rank.
+    """
+
+    def __init__(
+        self,
+        n_embed: int,
+        num_experts: int,
+        top_k: int,
+        router_class: Router,
+        stacked_experts: bool = False,
+        capacity_factor: Optional[float] = None,
+        process_group: Optional[dist.ProcessGroup] = None,
+    ) -> None:
+        # Read by _make_experts, which runs inside SparseMoE.__init__
+        self.process_group = process_group
+        self.world_size = dist.get_world_size(process_group)
+        self.rank = dist.get_rank(process_group)
+        assert (
+            num_experts % self.world_size == 0
+        ), f"{num_experts=} do not split evenly over {self.world_size} ranks"
+        self.num_local_experts = num_experts // self.world_size
+        if capacity_factor is None:
+            capacity_factor = DEFAULT_CAPACITY_FACTOR
+        super().__init__(
+            n_embed=n_embed,
+            num_experts=num_experts,
+            top_k=top_k,
+            router_class=router_class,
+            dispatch="padded",
+            stacked_experts=stacked_experts,
+            capacity_factor=capacity_factor,
+        )
+
+    def _make_experts(
+        self, n_embed: int, num_experts: int, stacked_experts: bool
+    ) -> nn.Module:
+        return super()._make_experts(n_embed, self.num_local_experts, stacked_experts)
+
+    def _run_experts(self, expert_inputs: torch.Tensor) -> torch.Tensor:
+        # expert_inputs is (num_experts, capacity, n_embed), its world_size
+        # equal chunks go to the ranks holding those experts
+        _, capacity, n_embed = expert_inputs.shape
+        received = all_to_all_single(
+            torch.empty_like(expert_inputs), expert_inputs, group=self.process_group
+        )
+        # (world_size, local experts, ...) -> every local expert's tokens from
+        # all ranks as one group
+        local_inputs = (
+            received.view(self.world_size, self.num_local_experts, capacity, n_embed)
+            .transpose(0, 1)
+            .reshape(self.num_local_experts, self.world_size * capacity, n_embed)
+        )
+        local_outputs = super()._run_experts(local_inputs)
+        outputs = (
+            local_outputs.view(self.num_local_experts, self.world_size, capacity, -1)
+            .transpose(0, 1)
+            .reshape(self.num_experts, capacity, n_embed)
+        )
+        return all_to_all_single(
+            torch.empty_like(outputs), outputs, group=self.process_group
+        )
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        # A checkpoint of the full layer loads this rank's share of the experts
+        expert_prefix = prefix + "experts."
+        expert_keys = [k for k in state_dict if k.startswith(expert_prefix)]
+        experts = {k[len(expert_prefix) :]: state_dict.pop(k) for k in expert_keys}
+        local = self.local_experts_state_dict(experts)
+        state_dict.update({expert_prefix + k: v for k, v in local.items()})
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def local_experts_state_dict(
+        self, experts: Dict[str, torch.Tensor]
+    ) -> Dict[str, torch.Tensor]:
+        """
+        This rank's share of the experts state dict of a full layer, keyed
+        relative to the experts module
+        """
+        start = self.rank * self.num_local_experts
+        stop = start + self.num_local_experts
+        indices = [
+            int(match["index"])
+            for match in map(_EXPERT_INDEX_KEY.match, experts)
+            if match is not None
+        ]
+        if indices and max(indices) >= self.num_local_experts:
+            # nn.ModuleList of every Expert, keep and renumber the local ones
+            local = {}
+            for key, value in experts.items():
+                match = _EXPERT_INDEX_KEY.match(key)
+                index = int(match["index"])
+                if start <= index < stop:
+                    local[f"{index - start}.{match['rest']}"] = value
+            return local
+        # ExpertBank weights of every expert are sliced along the expert dim
+        return {
+            key: value[start:stop] if value.size(0) == self.num_experts else value
+            for key, value in experts.items()
+        }
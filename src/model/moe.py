@@ -1,35 +1,332 @@
+import math
+import re
 from abc import ABC, abstractmethod
-from typing import Tuple
+from collections import OrderedDict, defaultdict
+from typing import Dict, Hashable, List, NamedTuple, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
 
+DISPATCH_MODES = ("loop", "sorted", "padded")
+# capacity_factor used where padded dispatch needs a fixed expert capacity and
+# none is given: room for 25% more than an even share of the assignments
+DEFAULT_CAPACITY_FACTOR = 1.25
+
+# Expert.net layer index and parameter name -> ExpertBank parameter name
+_EXPERT_TO_BANK = {
+    ("0", "weight"): "w1",
+    ("0", "bias"): "b1",
+    ("2", "weight"): "w2",
+    ("2", "bias"): "b2",
+}
+_BANK_TO_EXPERT = {v: k for k, v in _EXPERT_TO_BANK.items()}
+_EXPERT_KEY = re.compile(
+    r"^(?P<prefix>.*experts\.)(?P<index>\d+)\.net\.(?P<layer>[02])\.(?P<param>weight|bias)$"
+)
+_BANK_KEY = re.compile(r"^(?P<prefix>.*experts\.)(?P<param>w1|b1|w2|b2)$")
+
 
 class Router(nn.Module, ABC):
+    # Layout of the gating scores forward returns next to the (..., top_k)
+    # expert indices: "dense" scores are (..., num_experts) and zero outside
+    # the top-k, "compact" scores are (..., top_k) and aligned with the indices.
+    # "expert_choice" routers return (num_experts, capacity) scores and flat
+    # token indices instead, each expert's choice of tokens. The third output
+    # is the (..., num_experts) router logits before any routing noise, for
+    # the auxiliary losses, or None for routers without logits
+    output_format = "dense"
+    # Routers that route on the token ids get them as a second forward argument
+    requires_token_ids = False
+
     def __init__(self, n_embed: int, num_experts: int, top_k: int) -> None:
         super(Router, self).__init__()
         self.top_k = top_k
         self.num_experts = num_experts
 
     @abstractmethod
-    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(
+        self, x: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
         raise NotImplementedError
 
 
+class DispatchPlan(NamedTuple):
+    """
+    Token-expert assignments of one batch, sorted by expert so that every
+    expert reads a contiguous slice.
+    """
+
+    token_ids: torch.Tensor  # (N * top_k,) flat token feeding each assignment
+    expert_ids: torch.Tensor  # (N * top_k,) expert of each assignment, ascending
+    weights: torch.Tensor  # (N * top_k,) gating score of each assignment
+    counts: torch.Tensor  # (num_experts,) number of assignments per expert
+
+
+def make_dispatch_plan(
+    gating_output: torch.Tensor,
+    indices: torch.Tensor,
+    num_experts: int,
+    output_format: str = "dense",
+) -> DispatchPlan:
+    if output_format == "expert_choice":
+        # every expert already holds exactly capacity tokens, in expert order
+        num_experts, capacity = indices.shape
+        return DispatchPlan(
+            token_ids=indices.reshape(-1),
+            expert_ids=torch.arange(
+                num_experts, device=indices.device
+            ).repeat_interleave(capacity),
+            weights=gating_output.reshape(-1),
+            counts=torch.full(
+                (num_experts,), capacity, dtype=torch.long, device=indices.device
+            ),
+        )
+
+    flat_indices = indices.view(-1, indices.size(-1))  # (N, top_k)
+    flat_gating_output = gating_output.view(-1, gating_output.size(-1))
+    num_tokens, top_k = flat_indices.shape
+    if output_format == "dense":
+        flat_gating_output = flat_gating_output.gather(-1, flat_indices)
+
+    # Lay assignments out choice-major (every token's first choice, then every
+    # second choice, ...) so a stable sort keeps earlier choices first
+    expert_ids = flat_indices.t().reshape(-1)
+    token_ids = torch.arange(num_tokens, device=indices.device).repeat(top_k)
+    weights = flat_gating_output.t().reshape(-1)
+
+    expert_ids, order = torch.sort(expert_ids, stable=True)
+    return DispatchPlan(
+        token_ids=token_ids[order],
+        expert_ids=expert_ids,
+        weights=weights[order],
+        # unlike bincount, the shape of the counts never depends on the routing
+        counts=torch.zeros(
+            num_experts, dtype=torch.long, device=indices.device
+        ).scatter_add_(0, expert_ids, torch.ones_like(expert_ids)),
+    )
+
+
+class Routing(NamedTuple):
+    """
+    The router output for a batch and everything dispatch derives from it, so
+    that scoring the same batch again can skip routing altogether.
+    """
+
+    gating_output: torch.Tensor
+    indices: torch.Tensor
+    expert_counts: torch.Tensor  # (num_experts,) assignments per expert
+    dropped_assignments: torch.Tensor  # over capacity, always 0 unpadded
+    router_logits: Optional[torch.Tensor]  # for the auxiliary losses
+    plan: Optional[DispatchPlan] = None  # sorted and padded dispatch
+    split_sizes: Optional[List[int]] = None  # sorted dispatch, counts on the host
+    slots: Optional[torch.Tensor] = None  # padded dispatch, slot per assignment
+    capacity: int = 0  # padded dispatch, slots per expert
+
+
+class _RoutingLRU(OrderedDict):
+    """The Routing of one layer for its max_batches most recently used keys"""
+
+    def __init__(self, max_batches: int) -> None:
+        super().__init__()
+        self.max_batches = max_batches
+
+    def get(self, key: Hashable, default: Optional[Routing] = None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key: Hashable, routing: Routing) -> None:
+        super().__setitem__(key, routing)
+        self.move_to_end(key)
+        if len(self) > self.max_batches:
+            self.popitem(last=False)
+
+
+class DispatchPlanCache:
+    """
+    Routing of every MoE layer for batches a model in eval mode scored before,
+    see SparseMoELanguageModel.dispatch_plan_cache. Entries stay valid only
+    as long as the model's weights do not change. Every layer keeps the
+    routing of its max_batches most recently used batches.
+    """
+
+    def __init__(self, max_batches: int = 128) -> None:
+        self.max_batches = max_batches
+        self.layers: Dict[int, _RoutingLRU] = defaultdict(
+            lambda: _RoutingLRU(max_batches)
+        )
+
+    def clear(self) -> None:
+        self.layers.clear()
+
+
 class SparseMoE(nn.Module):
     def __init__(
-        self, n_embed: int, num_experts: int, top_k: int, router_class: Router
+        self,
+        n_embed: int,
+        num_experts: int,
+        top_k: int,
+        router_class: Router,
+        dispatch: str = "loop",
+        stacked_experts: bool = False,
+        capacity_factor: Optional[float] = None,
     ) -> None:
         super(SparseMoE, self).__init__()
+        assert (
+            dispatch in DISPATCH_MODES
+        ), f"Unknown {dispatch=} | Accepted values: {DISPATCH_MODES}"
+        assert (
+            not stacked_experts or dispatch == "padded"
+        ), f"Stacked experts need padded dispatch, got {dispatch=}"
+        assert (
+            capacity_factor is None or dispatch == "padded"
+        ), f"A capacity factor needs padded dispatch, got {dispatch=}"
+        assert (
+            router_class.output_format != "expert_choice" or dispatch != "loop"
+        ), f"{router_class.__name__} needs sorted or padded dispatch"
+        self.dispatch = dispatch
+        self.num_experts = num_experts
+        self.capacity_factor = capacity_factor
+        # Token-expert assignments dropped for exceeding expert capacity in the
+        # last forward. With top_k > 1 a token that loses one of its experts
+        # still goes through the others, so this is not a count of tokens
+        self.dropped_assignments: Optional[torch.Tensor] = None
+        # Assignments routed to each expert in the last forward, before capacity
+        self.expert_counts: Optional[torch.Tensor] = None
+        # Detached (load-balancing, router z-loss) of the last forward that
+        # returned them
+        self.aux_loss_stats: Optional[torch.Tensor] = None
+        # Routing of earlier batches by plan_key, set by the model to reuse it
+        self.plan_cache: Optional[Dict[Hashable, Routing]] = None
         self.router = router_class(
             n_embed=n_embed, num_experts=num_experts, top_k=top_k
         )
-        self.experts = nn.ModuleList(
-            [Expert(n_embed=n_embed) for _ in range(num_experts)]
+        self.experts = self._make_experts(n_embed, num_experts, stacked_experts)
+
+    def _make_experts(
+        self, n_embed: int, num_experts: int, stacked_experts: bool
+    ) -> nn.Module:
+        if stacked_experts:
+            return ExpertBank(n_embed=n_embed, num_experts=num_experts)
+        return nn.ModuleList([Expert(n_embed=n_embed) for _ in range(num_experts)])
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        token_ids: Optional[torch.Tensor] = None,
+        plan_key: Optional[Hashable] = None,
+        return_aux_losses: bool = False,
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        The layer output, and with return_aux_losses the (2,) load-balancing
+        and router z-loss of this forward, see aux_losses
+        """
+        # In eval mode routing is deterministic, so with a plan_cache the
+        # routing of a batch seen before under the same plan_key is reused
+        reuse = plan_key is not None and self.plan_cache is not None
+        reuse = reuse and not self.training
+        routing = self.plan_cache.get(plan_key) if reuse else None
+        if routing is None:
+            routing = self.route(x, token_ids)
+            if reuse:
+                self.plan_cache[plan_key] = routing
+        self.expert_counts = routing.expert_counts
+        self.dropped_assignments = routing.dropped_assignments
+        aux_losses = None
+        if return_aux_losses:
+            aux_losses = self.aux_losses(routing)
+            # only the detached values outlive the forward, for logging
+            self.aux_loss_stats = aux_losses.detach()
+
+        if self.dispatch == "sorted":
+            output = self._sorted_forward(x, routing)
+        elif self.dispatch == "padded":
+            output = self._padded_forward(x, routing)
+        else:
+            output = self._loop_forward(x, routing.gating_output, routing.indices)
+        return (output, aux_losses) if return_aux_losses else output
+
+    def route(
+        self, x: torch.Tensor, token_ids: Optional[torch.Tensor] = None
+    ) -> Routing:
+        if self.router.requires_token_ids:
+            gating_output, indices, router_logits = self.router(x, token_ids)
+        else:
+            gating_output, indices, router_logits = self.router(x)
+        if self.router.output_format == "compact" and self.dispatch == "loop":
+            # the loop reads every expert's column of the dense scores
+            gating_output = torch.zeros(
+                *indices.shape[:-1],
+                self.num_experts,
+                dtype=gating_output.dtype,
+                device=gating_output.device,
+            ).scatter(-1, indices, gating_output)
+        if self.router.output_format == "expert_choice":
+            expert_counts = torch.full(
+                (self.num_experts,), indices.size(-1), device=x.device
+            )
+        else:
+            flat_indices = indices.reshape(-1)
+            expert_counts = torch.zeros(
+                self.num_experts, dtype=torch.long, device=x.device
+            ).scatter_add_(0, flat_indices, torch.ones_like(flat_indices))
+        # Routing is built once with every field set: dynamo cannot trace
+        # NamedTuple._replace and would break the graph in every layer
+        plan, split_sizes, slots, capacity = None, None, None, 0
+        dropped_assignments = torch.zeros((), dtype=torch.long, device=x.device)
+        if self.dispatch != "loop":
+            plan = make_dispatch_plan(
+                gating_output, indices, self.num_experts, self.router.output_format
+            )
+        if self.dispatch == "sorted":
+            split_sizes = plan.counts.tolist()
+        elif self.dispatch == "padded":
+            slots, capacity, dropped_assignments = self._padded_slots(
+                plan, indices, num_tokens=x.numel() // x.size(-1)
+            )
+        return Routing(
+            gating_output=gating_output,
+            indices=indices,
+            expert_counts=expert_counts,
+            dropped_assignments=dropped_assignments,
+            router_logits=router_logits,
+            plan=plan,
+            split_sizes=split_sizes,
+            slots=slots,
+            capacity=capacity,
         )
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        gating_output, indices = self.router(x)
+    def _padded_slots(
+        self, plan: DispatchPlan, indices: torch.Tensor, num_tokens: int
+    ) -> Tuple[torch.Tensor, int, torch.Tensor]:
+        """
+        Slot of every assignment of plan in the (num_experts, capacity) token
+        groups of padded dispatch, the capacity and the dropped assignments
+        """
+        if self.router.output_format == "expert_choice":
+            # the router already fixed every expert's capacity
+            capacity = indices.size(-1)
+        elif self.capacity_factor is None:
+            capacity = int(plan.counts.max())
+        else:
+            capacity = self.expert_capacity(num_tokens, indices.size(-1))
+
+        offsets = plan.counts.cumsum(0) - plan.counts
+        positions = torch.arange(
+            len(plan.expert_ids), device=indices.device
+        ) - offsets.index_select(0, plan.expert_ids)
+
+        # Assignments past their expert's capacity all land in one extra slot
+        # that is never read back, so their tokens only take the residual path
+        num_slots = self.num_experts * capacity
+        kept = positions < capacity
+        slots = torch.where(kept, plan.expert_ids * capacity + positions, num_slots)
+        return slots, capacity, kept.numel() - kept.sum()
+
+    def _loop_forward(
+        self, x: torch.Tensor, gating_output: torch.Tensor, indices: torch.Tensor
+    ) -> torch.Tensor:
         final_output = torch.zeros_like(x)
 
         # Reshape inputs for batch processing
@@ -55,6 +352,175 @@ class SparseMoE(nn.Module):
 
         return final_output
 
+    def _sorted_forward(self, x: torch.Tensor, routing: Routing) -> torch.Tensor:
+        flat_x = x.view(-1, x.size(-1))
+        plan = routing.plan
+
+        # Gather once in expert order, then hand every expert its own slice
+        expert_inputs = flat_x[plan.token_ids]
+        expert_outputs = torch.cat(
+            [
+                expert(expert_input)
+                for expert, expert_input in zip(
+                    self.experts, expert_inputs.split(routing.split_sizes)
+                )
+            ]
+        )
+        weighted_output = expert_outputs * plan.weights.unsqueeze(1)
+
+        # Scatter every assignment back to its token in a single pass
+        final_output = torch.zeros_like(flat_x).index_add(
+            0, plan.token_ids, weighted_output
+        )
+        return final_output.view_as(x)
+
+    def _padded_forward(self, x: torch.Tensor, routing: Routing) -> torch.Tensor:
+        flat_x = x.view(-1, x.size(-1))
+        plan, slots, capacity = routing.plan, routing.slots, routing.capacity
+        num_slots = self.num_experts * capacity
+
+        expert_inputs = flat_x.new_zeros(num_slots + 1, x.size(-1))
+        expert_inputs = expert_inputs.index_copy(0, slots, flat_x[plan.token_ids])
+        expert_outputs = self._run_experts(
+            expert_inputs[:num_slots].view(self.num_experts, capacity, -1)
+        ).view(num_slots, -1)
+        expert_outputs = torch.cat(
+            [expert_outputs, expert_outputs.new_zeros(1, x.size(-1))]
+        )
+
+        weighted_output = expert_outputs[slots] * plan.weights.unsqueeze(1)
+        final_output = torch.zeros_like(flat_x).index_add(
+            0, plan.token_ids, weighted_output
+        )
+        return final_output.view_as(x)
+
+    def aux_losses(self, routing: Routing) -> torch.Tensor:
+        """
+        Auxiliary losses of a routing, as a (2,) tensor:
+        - the Switch Transformer load-balancing loss num_experts * sum_i f_i * P_i,
+          f_i being the fraction of assignments routed to expert i and P_i its
+          mean router probability, which is 1 when routing is uniform
+        - the ST-MoE router z-loss, the mean squared logsumexp of the logits,
+          which keeps the router logits small
+        Both are zero for routers without logits.
+        """
+        if routing.router_logits is None:
+            return torch.zeros(2, device=routing.expert_counts.device)
+        logits = routing.router_logits.reshape(-1, self.num_experts).float()
+        fractions = routing.expert_counts / routing.expert_counts.sum()
+        probs = logits.softmax(dim=-1).mean(dim=0)
+        load_balancing_loss = self.num_experts * (fractions * probs).sum()
+        router_z_loss = torch.logsumexp(logits, dim=-1).square().mean()
+        return torch.stack([load_balancing_loss, router_z_loss])
+
+    @staticmethod
+    def no_drop_capacity_factor(num_experts: int, top_k: int) -> float:
+        """
+        The capacity_factor giving every expert room for every token, so no
+        assignment is ever dropped while shapes still only depend on the batch
+        """
+        return num_experts / top_k
+
+    def expert_capacity(self, num_tokens: int, top_k: int) -> int:
+        """
+        Tokens each expert accepts per batch: capacity_factor times its even
+        share of the num_tokens * top_k assignments, never more than num_tokens
+        """
+        capacity = math.ceil(
+            self.capacity_factor * num_tokens * top_k / self.num_experts
+        )
+        return min(capacity, num_tokens)
+
+    def _run_experts(self, expert_inputs: torch.Tensor) -> torch.Tensor:
+        # expert_inputs is (num_experts, capacity, n_embed)
+        if isinstance(self.experts, ExpertBank):
+            return self.experts(expert_inputs)
+        return torch.stack(
+            [expert(group) for expert, group in zip(self.experts, expert_inputs)]
+        )
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        # Accept checkpoints saved with either expert layout
+        convert = (
+            stack_experts_state_dict
+            if isinstance(self.experts, ExpertBank)
+            else unstack_experts_state_dict
+        )
+        expert_keys = [k for k in state_dict if k.startswith(prefix + "experts.")]
+        state_dict.update(convert({k: state_dict.pop(k) for k in expert_keys}))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class ExpertBank(nn.Module):
+    """
+    All the Experts of a layer with their weights stacked along a leading
+    expert dimension, so every projection is a single batched matmul
+    """
+
+    def __init__(self, n_embed: int, num_experts: int, dropout: float = 0.1):
+        super().__init__()
+        self.w1 = nn.Parameter(torch.empty(num_experts, n_embed, 4 * n_embed))
+        self.b1 = nn.Parameter(torch.empty(num_experts, 4 * n_embed))
+        self.w2 = nn.Parameter(torch.empty(num_experts, 4 * n_embed, n_embed))
+        self.b2 = nn.Parameter(torch.empty(num_experts, n_embed))
+        self.dropout = nn.Dropout(dropout)
+        self.reset_parameters()
+
+    def reset_parameters(self) -> None:
+        # Same distribution nn.Linear draws its weights and biases from
+        for weight, bias in ((self.w1, self.b1), (self.w2, self.b2)):
+            bound = 1 / math.sqrt(weight.size(1))
+            nn.init.uniform_(weight, -bound, bound)
+            nn.init.uniform_(bias, -bound, bound)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # x is (num_experts, capacity, n_embed)
+        h = torch.baddbmm(self.b1.unsqueeze(1), x, self.w1).relu()
+        return self.dropout(torch.baddbmm(self.b2.unsqueeze(1), h, self.w2))
+
+
+def stack_experts_state_dict(
+    state_dict: Dict[str, torch.Tensor]
+) -> Dict[str, torch.Tensor]:
+    """
+    Converts every nn.ModuleList of Experts in a state dict to ExpertBank weights
+    """
+    converted = OrderedDict()
+    stacks = defaultdict(dict)
+    for key, value in state_dict.items():
+        match = _EXPERT_KEY.match(key)
+        if match is None:
+            converted[key] = value
+            continue
+        name = _EXPERT_TO_BANK[(match["layer"], match["param"])]
+        # nn.Linear stores (out, in) while the bank multiplies by (in, out)
+        value = value.t() if match["param"] == "weight" else value
+        stacks[match["prefix"] + name][int(match["index"])] = value
+    for key, values in stacks.items():
+        converted[key] = torch.stack([values[i] for i in sorted(values)])
+    return converted
+
+
+def unstack_experts_state_dict(
+    state_dict: Dict[str, torch.Tensor]
+) -> Dict[str, torch.Tensor]:
+    """
+    Converts every ExpertBank in a state dict to nn.ModuleList of Experts weights
+    """
+    converted = OrderedDict()
+    for key, value in state_dict.items():
+        match = _BANK_KEY.match(key)
+        if match is None:
+            converted[key] = value
+            continue
+        layer, param = _BANK_TO_EXPERT[match["param"]]
+        for i, expert_value in enumerate(value.unbind(0)):
+            if param == "weight":
+                expert_value = expert_value.t()
+            key = f"{match['prefix']}{i}.net.{layer}.{param}"
+            converted[key] = expert_value.clone(memory_format=torch.contiguous_format)
+    return converted
+
 
 class Expert(nn.Module):
     """
@@ -0,0 +1,155 @@
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from src.model.moe import Expert, ExpertBank, unstack_experts_state_dict
+
+QUANTIZATION_FORMAT = "int8_weight_only"
+
+
+def dynamic_quantization_available() -> bool:
+    """Whether this build has a quantized engine for CPU matmuls"""
+    return torch.backends.quantized.engine != "none"
+
+
+class Int8Linear(nn.Module):
+    """
+    nn.Linear with int8 weights and one fp32 scale per output channel, a
+    quarter of the weight bytes. On CPU the matmul runs as a dynamic
+    quantized linear, quantizing the activations on the fly, elsewhere the
+    weight is dequantized for a regular F.linear.
+
+    Only the CPU path is faster than nn.Linear. The other path dequantizes
+    the weight on every call: the weights stay a quarter of the size, but
+    every call pays for the dequantization.
+    """
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer(
+            "weight", torch.zeros(out_features, in_features, dtype=torch.int8)
+        )
+        self.register_buffer("scale", torch.ones(out_features))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+        # Prepacked for quantized::linear_dynamic, built on the first CPU call
+        self._packed: Optional[torch.ScriptObject] = None
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear) -> "Int8Linear":
+        layer = cls(linear.in_features, linear.out_features, linear.bias is not None)
+        weight = linear.weight.detach().float().cpu()
+        # Symmetric per output channel, so zero stays exactly zero
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        layer.weight.copy_(
+            torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8)
+        )
+        layer.scale.copy_(scale)
+        if linear.bias is not None:
+            layer.bias.copy_(linear.bias.detach().float())
+        return layer.to(linear.weight.device)
+
+    def dequantize(self) -> torch.Tensor:
+        return self.weight.float() * self.scale[:, None]
+
+    def packed_params(self) -> torch.ScriptObject:
+        if self._packed is None:
+            qweight = torch.quantize_per_channel(
+                self.dequantize().cpu(),
+                self.scale.cpu(),
+                torch.zeros(self.out_features, dtype=torch.long),
+                axis=0,
+                dtype=torch.qint8,
+            )
+            bias = None if self.bias is None else self.bias.cpu()
+            self._packed = torch.ops.quantized.linear_prepack(qweight, bias)
+        return self._packed
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if (
+            x.device.type == "cpu"
+            and x.dtype == torch.float32
+            and dynamic_quantization_available()
+        ):
+            # reduce_range as nn.quantized.dynamic.Linear does, fbgemm needs
+            # the headroom to not overflow its int16 accumulation
+            return torch.ops.quantized.linear_dynamic(x, self.packed_params(), True)
+        bias = None if self.bias is None else self.bias.to(x.dtype)
+        return F.linear(x, self.dequantize().to(x.dtype), bias)
+
+    def _load_from_state_dict(self, *args, **kwargs) -> None:
+        super()._load_from_state_dict(*args, **kwargs)
+        self._packed = None
+
+    def _apply(self, *args, **kwargs) -> "Int8Linear":
+        # .to(), .cuda() and the like replace the buffers that were packed
+        self._packed = None
+        return super()._apply(*args, **kwargs)
+
+    def extra_repr(self) -> str:
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, "
+            f"bias={self.bias is not None}"
+        )
+
+
+def quantize_linears(module: nn.Module) -> nn.Module:
+    """Replaces every nn.Linear inside module with an Int8Linear, in place"""
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, Int8Linear.from_linear(child))
+        else:
+            quantize_linears(child)
+    return module
+
+
+def unstack_expert_bank(bank: ExpertBank) -> nn.ModuleList:
+    """The Experts of an ExpertBank as an nn.ModuleList with the same weights"""
+    num_experts, n_embed, _ = bank.w1.shape
+    experts = nn.ModuleList(
+        [Expert(n_embed, dropout=bank.dropout.p) for _ in range(num_experts)]
+    )
+    state_dict = {f"experts.{k}": v for k, v in bank.state_dict().items()}
+    experts.load_state_dict(
+        {
+            k[len("experts.") :]: v
+            for k, v in unstack_experts_state_dict(state_dict).items()
+        }
+    )
+    return experts.to(bank.w1.device)
+
+
+def quantize_model(model: nn.Module) -> nn.Module:
+    """
+    Post-training int8 weight-only quantization of a SparseMoELanguageModel
+    for inference: the Expert and attention linears become Int8Linear, while
+    the embeddings, routers, layer norms and lm_head stay in full precision.
+    ExpertBanks are unstacked first, as Int8Linear has no batched form.
+    """
+    for block in model.blocks:
+        if isinstance(block.smoe.experts, ExpertBank):
+            block.smoe.experts = unstack_expert_bank(block.smoe.experts)
+        quantize_linears(block.smoe.experts)
+        quantize_linears(block.sa)
+    return model.eval()
+
+
+def save_quantized(model: nn.Module, path: str) -> None:
+    torch.save({"format": QUANTIZATION_FORMAT, "model": model.state_dict()}, path)
+
+
+def load_quantized(model: nn.Module, path: str) -> nn.Module:
+    """
+    Loads a save_quantized checkpoint into model, a SparseMoELanguageModel
+    built with the same arguments as the one that was saved
+    """
+    checkpoint = torch.load(path, map_location="cpu")
+    assert (
+        checkpoint.get("format") == QUANTIZATION_FORMAT
+    ), f"{path} is not a {QUANTIZATION_FORMAT} checkpoint"
+    model = quantize_model(model)
+    model.load_state_dict(checkpoint["model"])
+    return model
@@ -1,4 +1,5 @@
-from typing import Tuple
+import math
+from typing import Optional, Tuple
 
 import torch
 import torch.nn as nn
@@ -13,18 +14,151 @@ class NoisyTopKRouter(Router):
         self.top_k_route_linear = nn.Linear(n_embed, num_experts)
         self.noise_linear = nn.Linear(n_embed, num_experts)
 
-    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(
+        self, x: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
         # x is the output tensor from multi-head self attention block
-        logits = self.top_k_route_linear(x)
+        # Route in fp32 even under autocast, low precision logits flip top-k,
+        # so the projections run on fp32 inputs with autocast turned off
+        with torch.autocast(x.device.type, enabled=False):
+            x = x.float()
+            logits = self.top_k_route_linear(x)
 
-        # Adding scaled unit gaussian noise to the logits
-        noise = torch.randn_like(logits) * F.softplus(self.noise_linear(x))
-
-        noisy_logits = logits + noise
+            if self.training:
+                # Adding scaled unit gaussian noise to the logits
+                noise = torch.randn_like(logits) * F.softplus(self.noise_linear(x))
+                noisy_logits = logits + noise
+            else:
+                # Deterministic routing at inference, skipping the noise projection
+                noisy_logits = logits
 
         top_k_logits, indices = noisy_logits.topk(self.top_k, dim=-1)
         zeros = torch.full_like(noisy_logits, float("-inf"))
         sparse_logits = zeros.scatter(-1, indices, top_k_logits)
         router_output = F.softmax(sparse_logits, dim=-1)
 
-        return router_output, indices
+        return router_output, indices, logits
+
+
+class FusedTopKRouter(Router):
+    """
+    Routes like NoisyTopKRouter, but computes the logits and the noise scale
+    with a single projection and takes the softmax over the k selected logits
+    only, which equals the softmax over logits that are -inf outside the
+    top-k. Returns compact (..., top_k) weights instead of dense scores.
+    """
+
+    output_format = "compact"
+
+    def __init__(self, n_embed: int, num_experts: int, top_k: int) -> None:
+        super().__init__(n_embed, num_experts, top_k)
+        # logits in the first num_experts outputs, noise scale in the rest
+        self.route_linear = nn.Linear(n_embed, 2 * num_experts)
+
+    def forward(
+        self, x: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+        # fp32 routing, as in NoisyTopKRouter
+        with torch.autocast(x.device.type, enabled=False):
+            x = x.float()
+            if self.training:
+                logits, noise_scale = self.route_linear(x).chunk(2, dim=-1)
+                noise = torch.randn_like(logits) * F.softplus(noise_scale)
+                noisy_logits = logits + noise
+            else:
+                # Deterministic routing at inference, projecting the logits only
+                logits = F.linear(
+                    x,
+                    self.route_linear.weight[: self.num_experts],
+                    self.route_linear.bias[: self.num_experts],
+                )
+                noisy_logits = logits
+
+        top_k_logits, indices = noisy_logits.topk(self.top_k, dim=-1)
+        return F.softmax(top_k_logits, dim=-1), indices, logits
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        # Accept NoisyTopKRouter weights, fusing its two projections
+        if prefix + "top_k_route_linear.weight" in state_dict:
+            for param in ("weight", "bias"):
+                state_dict[f"{prefix}route_linear.{param}"] = torch.cat(
+                    [
+                        state_dict.pop(f"{prefix}top_k_route_linear.{param}"),
+                        state_dict.pop(f"{prefix}noise_linear.{param}"),
+                    ]
+                )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class ExpertChoiceRouter(Router):
+    """
+    Expert choice routing (Zhou et al., 2022): instead of every token picking
+    its top_k experts, every expert picks the capacity tokens of the batch with
+    the highest router probability for it. Capacity is N * top_k / num_experts
+    of the N tokens, so experts do the same work as top-k routing and the load
+    is balanced by construction. A token may be picked by any number of
+    experts, tokens no expert picks only take the residual path.
+
+    Which tokens an expert picks depends on every token of the batch, later
+    positions included, so routing at generation time differs from training.
+    """
+
+    output_format = "expert_choice"
+
+    def __init__(self, n_embed: int, num_experts: int, top_k: int) -> None:
+        super().__init__(n_embed, num_experts, top_k)
+        self.route_linear = nn.Linear(n_embed, num_experts)
+
+    def forward(
+        self, x: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+        # fp32 routing, as in NoisyTopKRouter
+        with torch.autocast(x.device.type, enabled=False):
+            logits = self.route_linear(x.float())
+        probs = F.softmax(logits.view(-1, self.num_experts), dim=-1)  # (N, E)
+
+        num_tokens = probs.size(0)
+        capacity = min(
+            math.ceil(num_tokens * self.top_k / self.num_experts), num_tokens
+        )
+        # (num_experts, capacity) probabilities and flat indices of the tokens
+        scores, indices = probs.t().topk(capacity, dim=-1)
+        return scores, indices, logits
+
+
+class HashRouter(Router):
+    """
+    Hash routing (Roller et al., 2021): a token's experts only depend on its
+    id, so routing needs no gating matmul and is the same at every position.
+    The first expert comes from a multiplicative hash of the token id and the
+    other top_k - 1 are the experts after it, each with weight 1 / top_k.
+    """
+
+    output_format = "compact"
+    requires_token_ids = True
+
+    # Knuth's multiplicative hash constant. It is 1 modulo every small power of
+    # two, so the low bits of the product equal those of the id: the expert
+    # is taken from the high bits of the 32-bit product instead
+    _HASH_MULTIPLIER = 2654435761
+
+    def forward(
+        self, x: torch.Tensor, token_ids: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, None]:
+        # token_ids is (B, T) and x the (B, T, C) hidden states of those tokens
+        hashed = (token_ids * self._HASH_MULTIPLIER) & 0xFFFFFFFF
+        # scales the 32-bit hash down to [0, num_experts) by its high bits
+        first_expert = (hashed * self.num_experts) >> 32
+        offsets = torch.arange(self.top_k, device=token_ids.device)
+        indices = (first_expert.unsqueeze(-1) + offsets) % self.num_experts
+        weights = torch.full(indices.shape, 1 / self.top_k, device=x.device)
+        return weights, indices, None
+
+
+# Routers train_loop and the experiments select by name
+ROUTERS = {
+    "noisy_top_k": NoisyTopKRouter,
+    "fused_top_k": FusedTopKRouter,
+    "expert_choice": ExpertChoiceRouter,
+    "hash": HashRouter,
+}
@@ -1,10 +1,122 @@
-from typing import Optional, Tuple
+import copy
+import re
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from typing import Dict, Hashable, Iterator, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
-from src.model.moe import Router, SparseMoE
+from src.model.moe import DispatchPlanCache, Router, SparseMoE
+
+_HEAD_KEY = re.compile(
+    r"^(?P<prefix>.*)heads\.(?P<index>\d+)\.(?P<param>key|query|value|tril)(?:\.weight)?$"
+)
+
+
+def autocast_dtype(device: torch.device) -> Optional[torch.dtype]:
+    """The dtype autocast currently runs ops on device in, None when it is off"""
+    if device.type == "cpu":
+        enabled = torch.is_autocast_cpu_enabled()
+        return torch.get_autocast_cpu_dtype() if enabled else None
+    enabled = torch.is_autocast_enabled()
+    return torch.get_autocast_gpu_dtype() if enabled else None
+
+
+class KVCache:
+    """
+    Preallocated keys and values of every layer, so incremental decoding only
+    has to compute the newest positions. Every sequence in the batch keeps its
+    own length, so sequences of different lengths can decode together.
+    """
+
+    def __init__(
+        self,
+        n_layer: int,
+        batch_size: int,
+        n_head: int,
+        head_size: int,
+        block_size: int,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> None:
+        shape = (n_layer, batch_size, n_head, block_size, head_size)
+        self.keys = torch.zeros(shape, device=device, dtype=dtype)
+        self.values = torch.zeros(shape, device=device, dtype=dtype)
+        self.block_size = block_size
+        # positions cached so far per sequence, kept on the host
+        self.lengths = torch.zeros(batch_size, dtype=torch.long)
+
+    def positions(self, num_positions: int) -> torch.Tensor:
+        """(B, num_positions) positions of the tokens that follow the cached ones"""
+        positions = self.lengths.unsqueeze(1) + torch.arange(num_positions)
+        return positions.to(self.keys.device)
+
+    def layer(self, i: int, positions: torch.Tensor) -> "LayerKVCache":
+        return LayerKVCache(self, i, positions)
+
+    def advance(self, num_positions: int) -> None:
+        self.lengths += num_positions
+
+    def rows(self, start: int, stop: int) -> "KVCache":
+        """A view of sequences [start, stop) sharing this cache's storage"""
+        view = copy.copy(self)
+        view.keys = self.keys[:, start:stop]
+        view.values = self.values[:, start:stop]
+        view.lengths = self.lengths[start:stop]
+        return view
+
+    def move_row(self, src: int, dst: int) -> None:
+        self.keys[:, dst] = self.keys[:, src]
+        self.values[:, dst] = self.values[:, src]
+        self.lengths[dst] = self.lengths[src]
+
+
+class LayerKVCache:
+    """The slice of a KVCache one attention layer reads and writes"""
+
+    def __init__(self, cache: KVCache, layer: int, positions: torch.Tensor) -> None:
+        self.cache = cache
+        self.layer = layer
+        self.positions = positions  # (B, T) positions of the newest tokens
+
+    def update(
+        self, k: torch.Tensor, v: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Stores the keys and values (B, n_head, T, head_size) of the T newest
+        positions and returns every cached key and value with a (B, 1, T, L)
+        mask of the ones each new position may attend to
+        """
+        end = int(self.cache.lengths.max()) + k.size(2)
+        assert end <= self.cache.block_size, f"KVCache is full, {end=}"
+        index = self.positions[:, None, :, None].expand_as(k)
+        # Under autocast k and v come out in the autocast dtype, not the cache's
+        dtype = self.cache.keys.dtype
+        keys = self.cache.keys[self.layer].scatter_(2, index, k.to(dtype))
+        values = self.cache.values[self.layer].scatter_(2, index, v.to(dtype))
+        mask = torch.arange(end, device=k.device) <= self.positions.unsqueeze(-1)
+        return keys[:, :, :end], values[:, :, :end], mask.unsqueeze(1)
+
+
+def cached_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    kv_cache: LayerKVCache,
+    scale: float,
+    dropout_p: float = 0.0,
+) -> torch.Tensor:
+    """
+    Causal attention of the T newest positions (B, n_head, T, head_size) over
+    themselves and every position already in kv_cache
+    """
+    keys, values, mask = kv_cache.update(k, v)
+    return F.scaled_dot_product_attention(
+        q.to(keys.dtype), keys, values, attn_mask=mask, dropout_p=dropout_p, scale=scale
+    )
 
 
 class Head(nn.Module):
@@ -59,11 +171,108 @@ class MultiHeadAttention(nn.Module):
         self.proj = nn.Linear(n_embed, n_embed)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x):
-        out = torch.cat([h(x) for h in self.heads], dim=-1)
+    def forward(
+        self, x: torch.Tensor, kv_cache: Optional[LayerKVCache] = None
+    ) -> torch.Tensor:
+        if kv_cache is None:
+            out = torch.cat([h(x) for h in self.heads], dim=-1)
+        else:
+            B, T, C = x.shape
+            q, k, v = (
+                torch.stack([getattr(h, name)(x) for h in self.heads], dim=1)
+                for name in ("query", "key", "value")
+            )  # (B, n_head, T, head_size)
+            out = cached_attention(
+                q,
+                k,
+                v,
+                kv_cache,
+                scale=C**-0.5,
+                dropout_p=self.heads[0].dropout.p if self.training else 0.0,
+            )
+            out = out.transpose(1, 2).reshape(B, T, -1)
+        out = self.dropout(self.proj(out))
+        return out
+
+
+class FusedMultiHeadAttention(nn.Module):
+    """
+    MultiHeadAttention with all heads computed together: one projection for the
+    queries, keys and values of every head and a single causal attention call
+    """
+
+    def __init__(
+        self,
+        num_heads: int,
+        head_size: int,
+        n_embed: int,
+        block_size: int,
+        dropout: float = 0.1,
+    ):
+        super().__init__()
+        self.num_heads = num_heads
+        self.head_size = head_size
+        self.qkv = nn.Linear(n_embed, 3 * num_heads * head_size, bias=False)
+        self.proj = nn.Linear(n_embed, n_embed)
+        self.attn_dropout = dropout
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(
+        self, x: torch.Tensor, kv_cache: Optional[LayerKVCache] = None
+    ) -> torch.Tensor:
+        B, T, C = x.shape
+        q, k, v = (
+            t.view(B, T, self.num_heads, self.head_size).transpose(1, 2)
+            for t in self.qkv(x).split(self.num_heads * self.head_size, dim=-1)
+        )  # (B, n_head, T, head_size)
+        dropout_p = self.attn_dropout if self.training else 0.0
+        # Head scales its scores by the embedding size, not the head size
+        if kv_cache is None:
+            out = F.scaled_dot_product_attention(
+                q, k, v, dropout_p=dropout_p, is_causal=True, scale=C**-0.5
+            )  # (B, n_head, T, head_size)
+        else:
+            out = cached_attention(
+                q, k, v, kv_cache, scale=C**-0.5, dropout_p=dropout_p
+            )
+        out = out.transpose(1, 2).reshape(B, T, self.num_heads * self.head_size)
         out = self.dropout(self.proj(out))
         return out
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        # Accept checkpoints saved from the per-head MultiHeadAttention
+        head_keys = [k for k in state_dict if k.startswith(prefix + "heads.")]
+        state_dict.update(
+            fuse_heads_state_dict({k: state_dict.pop(k) for k in head_keys})
+        )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def fuse_heads_state_dict(
+    state_dict: Dict[str, torch.Tensor]
+) -> Dict[str, torch.Tensor]:
+    """
+    Converts every per-head MultiHeadAttention in a state dict to
+    FusedMultiHeadAttention weights
+    """
+    converted = OrderedDict()
+    heads = defaultdict(lambda: defaultdict(dict))
+    for key, value in state_dict.items():
+        match = _HEAD_KEY.match(key)
+        if match is None:
+            converted[key] = value
+        elif match["param"] != "tril":  # the fused module keeps no mask buffer
+            heads[match["prefix"]][match["param"]][int(match["index"])] = value
+    for prefix, params in heads.items():
+        converted[prefix + "qkv.weight"] = torch.cat(
+            [
+                params[param][i]
+                for param in ("query", "key", "value")
+                for i in sorted(params[param])
+            ]
+        )
+    return converted
+
 
 class Block(nn.Module):
     """
@@ -78,11 +287,18 @@ class Block(nn.Module):
         top_k: int,
         block_size: int,
         router_class: Router,
+        dispatch: str = "loop",
+        stacked_experts: bool = False,
+        capacity_factor: Optional[float] = None,
+        fused_attention: bool = False,
     ) -> None:
         super().__init__()
         head_size = n_embed // n_head
 
-        self.sa = MultiHeadAttention(
+        attention_class = (
+            FusedMultiHeadAttention if fused_attention else MultiHeadAttention
+        )
+        self.sa = attention_class(
             num_heads=n_head,
             head_size=head_size,
             n_embed=n_embed,
@@ -93,15 +309,33 @@ class Block(nn.Module):
             num_experts=num_experts,
             top_k=top_k,
             router_class=router_class,
+            dispatch=dispatch,
+            stacked_experts=stacked_experts,
+            capacity_factor=capacity_factor,
         )
         self.ln1 = nn.LayerNorm(n_embed)
         self.ln2 = nn.LayerNorm(n_embed)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = x + self.sa(self.ln1(x))
-        output = self.smoe(self.ln2(x))
-        x = x + output
-        return x
+    def forward(
+        self,
+        x: torch.Tensor,
+        kv_cache: Optional[LayerKVCache] = None,
+        token_ids: Optional[torch.Tensor] = None,
+        plan_key: Optional[Hashable] = None,
+        return_aux_losses: bool = False,
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        x = x + self.sa(self.ln1(x), kv_cache=kv_cache)
+        # token_ids are only read by routers that route on them
+        output = self.smoe(
+            self.ln2(x),
+            token_ids=token_ids,
+            plan_key=plan_key,
+            return_aux_losses=return_aux_losses,
+        )
+        if return_aux_losses:
+            output, aux_losses = output
+            return x + output, aux_losses
+        return x + output
 
 
 class SparseMoELanguageModel(nn.Module):
@@ -115,8 +349,24 @@ class SparseMoELanguageModel(nn.Module):
         num_experts: int,
         top_k: int,
         router_class: Router,
+        dispatch: str = "loop",
+        stacked_experts: bool = False,
+        capacity_factor: Optional[float] = None,
+        fused_attention: bool = False,
+        checkpoint_every: int = 0,
+        load_balancing_coef: float = 0.0,
+        router_z_loss_coef: float = 0.0,
     ) -> None:
         super().__init__()
+        # recompute every checkpoint_every-th block in backward, 0 never does
+        self.checkpoint_every = checkpoint_every
+        # weights of the MoE auxiliary losses added to the training loss
+        self.load_balancing_coef = load_balancing_coef
+        self.router_z_loss_coef = router_z_loss_coef
+        # set while dispatch_plan_cache is active
+        self.plan_cache: Optional[DispatchPlanCache] = None
+        self.n_head = n_head
+        self.head_size = n_embed // n_head
         self.token_embedding_table = nn.Embedding(vocab_size, n_embed)
         self.position_embedding_table = nn.Embedding(block_size, n_embed)
 
@@ -129,6 +379,10 @@ class SparseMoELanguageModel(nn.Module):
                     top_k=top_k,
                     router_class=router_class,
                     block_size=block_size,
+                    dispatch=dispatch,
+                    stacked_experts=stacked_experts,
+                    capacity_factor=capacity_factor,
+                    fused_attention=fused_attention,
                 )
                 for _ in range(n_layer)
             ]
@@ -138,17 +392,70 @@ class SparseMoELanguageModel(nn.Module):
         self.lm_head = nn.Linear(n_embed, vocab_size)
 
     def forward(
-        self, idx: torch.Tensor, targets: Optional[torch.Tensor] = None
+        self,
+        idx: torch.Tensor,
+        targets: Optional[torch.Tensor] = None,
+        kv_cache: Optional[KVCache] = None,
+        plan_id: Optional[Hashable] = None,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        plan_id names the batch idx holds for dispatch_plan_cache, which only
+        reuses routing for forward calls that pass one
+        """
         B, T = idx.shape
+        if kv_cache is None:
+            positions = torch.arange(T, device=idx.device)  # (T)
+        else:
+            # idx only holds the tokens that follow the cached ones
+            positions = kv_cache.positions(T)  # (B,T)
 
         # idx and targets are both (B,T) tensor of integers
         tok_emb = self.token_embedding_table(idx)  # (B,T,C)
-        pos_emb = self.position_embedding_table(
-            torch.arange(T, device=idx.device)
-        )  # (T,C)
+        pos_emb = self.position_embedding_table(positions)  # (T,C) or (B,T,C)
         x = tok_emb + pos_emb  # (B,T,C)
-        x = self.blocks(x)  # (B,T,C)
+        plan_key = None
+        reuse = plan_id is not None and self.plan_cache is not None
+        if reuse and not self.training and kv_cache is None:
+            # routing in eval mode only depends on the tokens and the precision
+            # they are computed in, the caller names the tokens so that they
+            # need not be read back to the host
+            precision = (x.dtype, autocast_dtype(x.device))
+            plan_key = (plan_id, tuple(idx.shape), precision)
+        # The auxiliary losses come back from every block with the graph to the
+        # router logits, nothing holding it stays behind on the modules
+        with_aux_losses = (
+            self.training
+            and targets is not None
+            and bool(self.load_balancing_coef or self.router_z_loss_coef)
+        )
+        aux_losses = []
+        for i, block in enumerate(self.blocks):
+            if kv_cache is not None:
+                x = block(x, kv_cache=kv_cache.layer(i, positions), token_ids=idx)
+                continue
+            if self.is_checkpointed(i):
+                # Keep only the block's input and recompute the rest in backward,
+                # replaying the RNG so router noise and dropout come out the same
+                x = checkpoint(
+                    block,
+                    x,
+                    token_ids=idx,
+                    return_aux_losses=with_aux_losses,
+                    use_reentrant=False,
+                    preserve_rng_state=True,
+                )
+            else:
+                x = block(
+                    x,
+                    token_ids=idx,
+                    plan_key=plan_key,
+                    return_aux_losses=with_aux_losses,
+                )  # (B,T,C)
+            if with_aux_losses:
+                x, block_aux_losses = x
+                aux_losses.append(block_aux_losses)
+        if kv_cache is not None:
+            kv_cache.advance(T)
         x = self.ln_f(x)  # (B,T,C)
         logits = self.lm_head(x)  # (B,T,vocab_size)
 
@@ -157,21 +464,107 @@ class SparseMoELanguageModel(nn.Module):
         else:
             B, T, C = logits.shape
             logits = logits.view(B * T, C)
-            targets = targets.view(B * T)
-            loss = F.cross_entropy(logits, targets)
+            targets = targets.reshape(B * T)
+            # fp32 loss even when the logits come out of autocast
+            loss = F.cross_entropy(logits.float(), targets)
+            if with_aux_losses:
+                load_balancing_loss, router_z_loss = torch.stack(aux_losses).sum(0)
+                loss = (
+                    loss
+                    + self.load_balancing_coef * load_balancing_loss
+                    + self.router_z_loss_coef * router_z_loss
+                )
 
         return logits, loss
 
+    def is_checkpointed(self, layer: int) -> bool:
+        return (
+            self.training
+            and self.checkpoint_every > 0
+            and layer % self.checkpoint_every == 0
+        )
+
+    def dropped_assignments(self) -> torch.Tensor:
+        """
+        Token-expert assignments each layer dropped for exceeding expert capacity
+        in the last forward pass, as a (n_layer,) tensor left on the model's device
+        """
+        return torch.stack([block.smoe.dropped_assignments for block in self.blocks])
+
+    def aux_loss_stats(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Detached load-balancing and router z-loss of the last training forward
+        pass, summed over the layers (see SparseMoE.aux_losses), for logging.
+        They are only computed with a load_balancing_coef or router_z_loss_coef
+        """
+        losses = torch.stack([block.smoe.aux_loss_stats for block in self.blocks])
+        losses = losses.sum(dim=0)
+        return losses[0], losses[1]
+
+    def expert_counts(self) -> torch.Tensor:
+        """
+        Assignments routed to each expert of each layer in the last forward pass,
+        as a (n_layer, num_experts) tensor left on the model's device
+        """
+        return torch.stack([block.smoe.expert_counts for block in self.blocks])
+
+    @contextmanager
+    def dispatch_plan_cache(
+        self, cache: Optional[DispatchPlanCache] = None
+    ) -> Iterator[DispatchPlanCache]:
+        """
+        While active, every MoE layer stores its routing and dispatch plan per
+        batch of tokens in cache and reuses them when the same batch comes
+        again, e.g. to score the same prompts repeatedly. Applies in eval mode
+        without a KV cache only, where routing depends on the tokens alone.
+
+        Batches are told apart by the plan_id passed to forward, the caller
+        must only reuse an id for the same tokens. Entries are also kept
+        apart by batch shape, parameter dtype and autocast dtype.
+        """
+        cache = DispatchPlanCache() if cache is None else cache
+        self.plan_cache = cache
+        for i, block in enumerate(self.blocks):
+            block.smoe.plan_cache = cache.layers[i]
+        try:
+            yield cache
+        finally:
+            self.plan_cache = None
+            for block in self.blocks:
+                block.smoe.plan_cache = None
+
+    def make_kv_cache(self, batch_size: int, block_size: int) -> KVCache:
+        return KVCache(
+            n_layer=len(self.blocks),
+            batch_size=batch_size,
+            n_head=self.n_head,
+            head_size=self.head_size,
+            block_size=block_size,
+            device=self.lm_head.weight.device,
+            dtype=self.lm_head.weight.dtype,
+        )
+
     def generate(
-        self, idx: torch.Tensor, max_new_tokens: int, block_size: int
+        self,
+        idx: torch.Tensor,
+        max_new_tokens: int,
+        block_size: int,
+        use_cache: bool = False,
     ) -> torch.Tensor:
         # idx is (B, T) array of indices in the current context
+        kv_cache = None
         for _ in range(max_new_tokens):
-            # crop idx to the last block_size tokens
-            idx_cond = idx[:, -block_size:]
-
-            # get the predictions
-            logits, _ = self(idx_cond)
+            if not use_cache or idx.size(1) > block_size:
+                # crop idx to the last block_size tokens; once the window
+                # slides, every position moves and cached keys go stale
+                logits, _ = self(idx[:, -block_size:])
+            elif kv_cache is None:
+                # prefill the cache with the whole prompt
+                kv_cache = self.make_kv_cache(idx.size(0), block_size)
+                logits, _ = self(idx, kv_cache=kv_cache)
+            else:
+                # only the newest token has not been through the model yet
+                logits, _ = self(idx[:, -1:], kv_cache=kv_cache)
 
             # focus only on the last time step
             logits = logits[:, -1, :]  # becomes (B, C)
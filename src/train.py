@@ -1,46 +1,177 @@
-from typing import Callable, List, NamedTuple, TypedDict
+import time
+from contextlib import nullcontext
+from functools import partial
+from typing import (
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    TypedDict,
+)
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
-import wandb
 from torch.nn import init
+from torch.nn.parallel import DistributedDataParallel
 
+from src.data.bpe import BPETokenizer
 from src.data.loader import Loader
-from src.data.tokenizer import Tokenizer
-from src.model.moe import Router
-from src.model.routers import NoisyTopKRouter
+from src.data.prefetch import BatchPrefetcher
+from src.data.tokenizer import TOKENIZERS
+from src.model.moe import DEFAULT_CAPACITY_FACTOR, ExpertBank, Router
+from src.model.routers import ROUTERS
 from src.model.transformer import SparseMoELanguageModel
+from src.utils.checkpoint import CheckpointManager, latest_checkpoint, load_checkpoint
+from src.utils.distributed import (
+    distributed_device,
+    init_distributed,
+    single_process,
+    unwrap_model,
+)
+from src.utils.memory import peak_memory_mb
+from src.utils.metrics import MetricsLogger, make_sinks
 
 torch.manual_seed(42)
 
+# autocast dtype of every training precision, None trains without autocast
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
 
-class CheckpointLoss(TypedDict):
+
+class CheckpointLoss(TypedDict, total=False):
+    # train is left out when evaluation skips the train split
     train: float
     val: float
 
 
-@torch.no_grad()
+def autocast(device: torch.device, precision: str) -> torch.autocast:
+    assert (
+        precision in PRECISIONS
+    ), f"Unknown {precision=} | Accepted values: {PRECISIONS.keys()}"
+    assert (
+        precision != "fp16" or device.type == "cuda"
+    ), "fp16 autocast needs a CUDA device, use bf16 on CPU"
+    return torch.autocast(
+        device_type=device.type,
+        dtype=PRECISIONS[precision],
+        enabled=PRECISIONS[precision] is not None,
+    )
+
+
+def train_step(
+    model: SparseMoELanguageModel,
+    optimizer: torch.optim.Optimizer,
+    scaler: torch.cuda.amp.GradScaler,
+    xb: torch.Tensor,
+    yb: torch.Tensor,
+    precision: str = "fp32",
+    grad_accum_steps: int = 1,
+) -> torch.Tensor:
+    """
+    One optimizer step on a batch, returning the loss without syncing on it.
+    With grad_accum_steps > 1 the batch is split into that many micro-batches
+    whose gradients are accumulated, so only one micro-batch of activations
+    is alive at a time. The scaler only scales the loss when enabled for fp16.
+    A DistributedDataParallel model all-reduces gradients once, after the last
+    micro-batch.
+    """
+    assert (
+        len(xb) % grad_accum_steps == 0
+    ), f"batch of {len(xb)} does not split into {grad_accum_steps=} micro-batches"
+    optimizer.zero_grad(set_to_none=True)
+    total_loss = torch.zeros((), device=xb.device)
+    for i, (micro_xb, micro_yb) in enumerate(
+        zip(xb.chunk(grad_accum_steps), yb.chunk(grad_accum_steps))
+    ):
+        skip_sync = (
+            isinstance(model, DistributedDataParallel) and i < grad_accum_steps - 1
+        )
+        with model.no_sync() if skip_sync else nullcontext():
+            with autocast(xb.device, precision):
+                _, loss = model(micro_xb, micro_yb)
+            loss = loss.mean() / grad_accum_steps
+            scaler.scale(loss).backward()
+        total_loss += loss.detach()
+    scaler.step(optimizer)
+    scaler.update()
+    return total_loss
+
+
+@torch.inference_mode()
 def estimate_loss(
-    model: SparseMoELanguageModel, get_batch: Callable, eval_iters: int = 100
+    model: SparseMoELanguageModel,
+    get_batch: Callable,
+    eval_iters: int = 100,
+    precision: str = "fp32",
+    splits: Sequence[str] = ("train", "val"),
 ) -> CheckpointLoss:
     device = next(model.parameters()).device
-    out = {}
+    # losses stay on the device and are read back with a single sync
+    losses = torch.zeros(len(splits), eval_iters, device=device)
     model.eval()
-    for split in ["train", "val"]:
-        losses = torch.zeros(eval_iters)
+    for i, split in enumerate(splits):
         for k in range(eval_iters):
             X, Y = get_batch(split)
             X, Y = X.to(device), Y.to(device)
-            _, loss = model(X, Y)
-            losses[k] = loss.mean().item()
-        out[split] = losses.mean()
+            with autocast(device, precision):
+                _, loss = model(X, Y)
+            losses[i, k] = loss.mean()
+    model.train()
+    return CheckpointLoss(zip(splits, losses.mean(dim=1).tolist()))
+
+
+@torch.inference_mode()
+def evaluate(
+    model: SparseMoELanguageModel,
+    eval_sets: Dict[str, Tuple[torch.Tensor, torch.Tensor]],
+    batch_size: int,
+    precision: str = "fp32",
+) -> CheckpointLoss:
+    """
+    Mean loss over every sample of fixed eval sets from Loader.sample_eval_set,
+    batch_size samples at a time, with a single sync at the end
+    """
+    device = next(model.parameters()).device
+    totals = torch.zeros(len(eval_sets), device=device)
+    model.eval()
+    for i, (X, Y) in enumerate(eval_sets.values()):
+        for xb, yb in zip(X.split(batch_size), Y.split(batch_size)):
+            with autocast(device, precision):
+                _, loss = model(xb.to(device), yb.to(device))
+            totals[i] += loss.mean().float() * len(xb)
     model.train()
-    return CheckpointLoss(train=out["train"], val=out["val"])
+    num_samples = torch.tensor([len(X) for X, _ in eval_sets.values()], device=device)
+    return CheckpointLoss(zip(eval_sets, (totals / num_samples).tolist()))
+
+
+def expert_load_metrics(expert_counts: torch.Tensor) -> Dict[str, torch.Tensor]:
+    """
+    Share of the assignments every expert of every layer received from
+    (n_layer, num_experts) counts, and per layer the load of the busiest
+    expert relative to an even split, 1 being perfectly balanced. The values
+    stay on the device for MetricsLogger.
+    """
+    load = expert_counts / expert_counts.sum(dim=-1, keepdim=True).clamp(min=1)
+    metrics = {}
+    for layer, layer_load in enumerate(load):
+        metrics[f"expert_load/layer_{layer}/max"] = layer_load.max() * len(layer_load)
+        for expert, share in enumerate(layer_load):
+            metrics[f"expert_load/layer_{layer}/expert_{expert}"] = share
+    return metrics
 
 
 def kaiming_init_weights(m):
     if isinstance(m, (nn.Linear)):
         init.kaiming_normal_(m.weight)
+    elif isinstance(m, ExpertBank):
+        # Initialize each expert as the (out, in) weight of its nn.Linear
+        with torch.no_grad():
+            for weight in (m.w1, m.w2):
+                for i in range(weight.size(0)):
+                    init.kaiming_normal_(weight[i].t())
 
 
 def get_model(
@@ -52,7 +183,21 @@ def get_model(
     n_head: int = 8,
     num_experts: int = 8,
     top_k: int = 2,
+    dispatch: str = "loop",
+    stacked_experts: bool = False,
+    capacity_factor: Optional[float] = None,
+    fused_attention: bool = False,
+    checkpoint_every: int = 0,
+    load_balancing_coef: float = 0.0,
+    router_z_loss_coef: float = 0.0,
+    compile: bool = False,
 ) -> SparseMoELanguageModel:
+    if compile:
+        # torch.compile needs MoE shapes that do not depend on the routing, so
+        # experts get a fixed capacity and assignments beyond it are dropped
+        assert dispatch == "padded", f"compile needs padded dispatch, got {dispatch=}"
+        if capacity_factor is None:
+            capacity_factor = DEFAULT_CAPACITY_FACTOR
     model = SparseMoELanguageModel(
         vocab_size=vocab_size,
         n_embed=n_embed,
@@ -62,9 +207,18 @@ def get_model(
         num_experts=num_experts,
         top_k=top_k,
         router_class=router_class,
+        dispatch=dispatch,
+        stacked_experts=stacked_experts,
+        capacity_factor=capacity_factor,
+        fused_attention=fused_attention,
+        checkpoint_every=checkpoint_every,
+        load_balancing_coef=load_balancing_coef,
+        router_z_loss_coef=router_z_loss_coef,
     )
     print(sum(p.numel() for p in model.parameters()) / 1e6, "M parameters")
     model.apply(kaiming_init_weights)
+    if compile:
+        model = torch.compile(model)
     return model
 
 
@@ -87,27 +241,126 @@ def train_loop(
     n_embed: int = 128,
     n_layer: int = 8,
     n_head: int = 8,
+    router: str = "noisy_top_k",
+    dispatch: str = "loop",
+    stacked_experts: bool = False,
+    capacity_factor: Optional[float] = None,
+    fused_attention: bool = False,
+    shard_file: Optional[str] = None,
+    tokenizer_file: Optional[str] = None,
+    tokenizer_type: str = "char",
+    num_prefetch: int = 2,
+    precision: str = "fp32",
+    compile: bool = False,
+    grad_accum_steps: int = 1,
+    checkpoint_every: int = 0,
+    load_balancing_coef: float = 0.0,
+    router_z_loss_coef: float = 0.0,
+    distributed: bool = False,
+    backend: str = "gloo",
+    checkpoint_path: Optional[str] = None,
+    eval_iters: int = 100,
+    eval_batch_size: Optional[int] = None,
+    fixed_eval_set: bool = False,
+    eval_train_split: bool = True,
+    sinks: Sequence[str] = ("wandb",),
+    log_dir: str = "logs",
+    log_flush_every: int = 50,
+    checkpoint_dir: Optional[str] = None,
+    checkpoint_interval: int = 1000,
+    keep_checkpoints: int = 3,
+    resume_from: Optional[str] = None,
     device: str = "cuda",
 ) -> TrainerResults:
+    """
+    With distributed=True, train_loop runs data parallel in every process of a
+    torchrun launch, e.g.
+        torchrun --nproc_per_node=4 -m experiments.noisy_top_k_2_ddp
+    batch_size is per rank and every rank samples its own batches. Evaluation,
+    logging and the checkpoint at checkpoint_path happen on rank 0 only.
+
+    Evaluation runs eval_iters batches of eval_batch_size, by default one
+    micro-batch, per split. They are freshly sampled at every eval interval,
+    or with fixed_eval_set=True sampled once with a fixed seed, so that losses
+    are comparable across evaluations and runs. eval_train_split=False only
+    evaluates val, the logged training loss already follows the train split.
+
+    tokenizer_type names the character tokenizer in src.data.tokenizer.TOKENIZERS,
+    which must be the one a shard_file was prepared with. A tokenizer_file of
+    a BPETokenizer takes precedence.
+    router names the Router class in src.model.routers.ROUTERS.
+    compile needs dispatch="padded" and caps the expert capacity at
+    capacity_factor, DEFAULT_CAPACITY_FACTOR if not given. The assignments
+    dropped over capacity are logged at every eval interval.
+    load_balancing_coef and router_z_loss_coef weight the MoE auxiliary losses
+    added to the training loss, see SparseMoE.aux_losses.
+
+    Metrics go to every sink in sinks (see src.utils.metrics.SINKS), the file
+    sinks write to log_dir. They are buffered on the device and written from
+    a background thread every log_flush_every steps.
+
+    With a checkpoint_dir, every checkpoint_interval steps the model, optimizer,
+    grad scaler, RNG and batch sampling state is saved there in the background,
+    keeping the last keep_checkpoints. resume_from, a checkpoint file or a
+    checkpoint_dir to take the newest from, continues such a run where it
+    stopped, with the same world size.
+    """
     device = torch.device(device if torch.cuda.is_available() else "cpu")
+    if distributed:
+        context = init_distributed(backend)
+        device = distributed_device(device, context.local_rank)
+    else:
+        context = single_process()
 
-    wandb.init(  # type: ignore
-        project="moe_9M",
-        name=experiment_name,
-        group=experiment_group,
-        config={
-            "lr": lr,
-            "max_iters": max_iters,
-            "eval_interval": eval_interval,
-            "batch_size": batch_size,
-            "block_size": block_size,
-            "top_k": top_k,
-        },
+    config = {
+        "lr": lr,
+        "max_iters": max_iters,
+        "eval_interval": eval_interval,
+        "batch_size": batch_size,
+        "block_size": block_size,
+        "top_k": top_k,
+        "router": router,
+        "dispatch": dispatch,
+        "stacked_experts": stacked_experts,
+        "capacity_factor": capacity_factor,
+        "fused_attention": fused_attention,
+        "tokenizer_file": tokenizer_file,
+        "tokenizer_type": tokenizer_type,
+        "precision": precision,
+        "compile": compile,
+        "grad_accum_steps": grad_accum_steps,
+        "checkpoint_every": checkpoint_every,
+        "load_balancing_coef": load_balancing_coef,
+        "router_z_loss_coef": router_z_loss_coef,
+        "world_size": context.world_size,
+        "eval_iters": eval_iters,
+        "eval_batch_size": eval_batch_size,
+        "fixed_eval_set": fixed_eval_set,
+        "eval_train_split": eval_train_split,
+    }
+    # only rank 0 logs, the other ranks get no sinks
+    metrics = MetricsLogger(
+        make_sinks(
+            sinks if context.is_main else (),
+            experiment_name=experiment_name,
+            experiment_group=experiment_group,
+            config=config,
+            log_dir=log_dir,
+        ),
+        flush_every=log_flush_every,
     )
 
-    tokenizer = Tokenizer()
-    loader = Loader(tokenizer)
+    # a BPETokenizer saved by src.data.bpe, or a character tokenizer by name
+    if tokenizer_file is not None:
+        tokenizer = BPETokenizer.load(tokenizer_file)
+    else:
+        assert (
+            tokenizer_type in TOKENIZERS
+        ), f"Unknown {tokenizer_type=} | Accepted values: {TOKENIZERS.keys()}"
+        tokenizer = TOKENIZERS[tokenizer_type]()
+    loader = Loader(tokenizer, shard_file=shard_file)
 
+    assert router in ROUTERS, f"Unknown {router=} | Accepted values: {ROUTERS.keys()}"
     model = get_model(
         vocab_size=tokenizer.vocab_size,
         block_size=block_size,
@@ -116,45 +369,225 @@ def train_loop(
         n_layer=n_layer,
         n_head=n_head,
         num_experts=n_experts,
-        router_class=NoisyTopKRouter,  # type: ignore
+        router_class=ROUTERS[router],  # type: ignore
+        dispatch=dispatch,
+        stacked_experts=stacked_experts,
+        capacity_factor=capacity_factor,
+        fused_attention=fused_attention,
+        checkpoint_every=checkpoint_every,
+        load_balancing_coef=load_balancing_coef,
+        router_z_loss_coef=router_z_loss_coef,
+        compile=compile,
     )
 
-    # Make it data parallel
-    # if torch.cuda.device_count() > 1:
-    #     model = nn.DataParallel(model)
-
     model = model.to(device)
+    resume_state, start_iter = {}, 0
+    if resume_from is not None:
+        resume_path = latest_checkpoint(resume_from)
+        assert resume_path is not None, f"No checkpoint to resume from in {resume_from}"
+        resume_state = load_checkpoint(resume_path)
+        assert (
+            len(resume_state["ranks"]) == context.world_size
+        ), f"{resume_path} was saved by {len(resume_state['ranks'])} ranks"
+        unwrap_model(model).load_state_dict(resume_state["model"])
+        start_iter = resume_state["step"]
+        print(f"resuming from {resume_path} at step {start_iter}")
+    # rank 0 evaluates its local replica, outside of the gradient all-reduce
+    local_model = model
+    if distributed:
+        # experts that no token was routed to get no gradient in a step
+        model = DistributedDataParallel(
+            model,
+            device_ids=[device.index] if device.type == "cuda" else None,
+            find_unused_parameters=True,
+        )
 
     # create a PyTorch optimizer
     optimizer = torch.optim.AdamW(model.parameters(), lr=lr)
+    # fp16 gradients can underflow, so its loss is scaled before backward
+    scaler = torch.cuda.amp.GradScaler(enabled=precision == "fp16")
+    if resume_state:
+        optimizer.load_state_dict(resume_state["optimizer"])
+        scaler.load_state_dict(resume_state["scaler"])
 
-    train_losses, val_losses = [], []
-    for iter in range(max_iters):
-        # every once in a while evaluate the loss on train and val sets
-        if iter % eval_interval == 0 or iter == max_iters - 1:
-            losses = estimate_loss(
-                model=model,
-                get_batch=lambda split: loader.get_batch(split, batch_size, block_size),
+    # sample batches on background threads, each split from its own generator
+    prefetch = partial(
+        BatchPrefetcher,
+        loader,
+        block_size=block_size,
+        device=device,
+        num_prefetch=num_prefetch,
+    )
+    # every rank draws a different sequence of batches, continued on resume
+    batch_states = {}
+    if resume_state:
+        batch_states = resume_state["ranks"][context.rank]["batches"]
+    train_seed = 42 + 100 * context.rank
+    train_batches = prefetch(
+        "train", batch_size=batch_size, seed=train_seed, **batch_states.get("train", {})
+    )
+    # evaluate one micro-batch at a time, so eval fits wherever training does
+    eval_batch_size = eval_batch_size or batch_size // grad_accum_steps
+    eval_splits = ("train", "val") if eval_train_split else ("val",)
+    eval_batches = {}
+    if context.is_main and fixed_eval_set:
+        eval_sets = {
+            split: loader.sample_eval_set(
+                split, eval_iters * eval_batch_size, block_size, device=device
             )
-            print(
-                f"step {iter}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}"
+            for split in eval_splits
+        }
+        evaluate_model = partial(
+            evaluate, eval_sets=eval_sets, batch_size=eval_batch_size
+        )
+    elif context.is_main:
+        eval_seeds = {"train": 43, "val": 44}
+        eval_batches = {
+            split: prefetch(
+                split,
+                batch_size=eval_batch_size,
+                seed=eval_seeds[split],
+                **batch_states.get(f"eval_{split}", {}),
             )
-            wandb.log(  # type: ignore
-                {"train_loss": losses["train"], "val_loss": losses["val"]}, step=iter
+            for split in eval_splits
+        }
+        evaluate_model = partial(
+            estimate_loss,
+            get_batch=lambda split: next(eval_batches[split]),
+            eval_iters=eval_iters,
+            splits=eval_splits,
+        )
+
+    checkpoints = None
+    if checkpoint_dir is not None and context.is_main:
+        checkpoints = CheckpointManager(checkpoint_dir, keep_last=keep_checkpoints)
+
+    def save_checkpoint(step: int) -> None:
+        # RNG and batch sampling state differ per rank, rank 0 saves them all
+        rank_state = {
+            "rng": torch.get_rng_state(),
+            "cuda_rng": (
+                torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+            ),
+            "batches": {
+                "train": train_batches.state_dict(),
+                **{f"eval_{k}": v.state_dict() for k, v in eval_batches.items()},
+            },
+        }
+        ranks = [rank_state]
+        if distributed:
+            ranks = [None] * context.world_size
+            dist.all_gather_object(ranks, rank_state)
+        if checkpoints is not None:
+            checkpoints.save(
+                step,
+                {
+                    "step": step,
+                    "model": unwrap_model(model).state_dict(),
+                    "optimizer": optimizer.state_dict(),
+                    "scaler": scaler.state_dict(),
+                    "ranks": ranks,
+                },
             )
-            val_losses.append(losses["val"])
 
-        # sample a batch of data
-        xb, yb = loader.get_batch("train", batch_size=batch_size, block_size=block_size)
-        xb, yb = xb.to(device), yb.to(device)
+    if resume_state:
+        rank_state = resume_state["ranks"][context.rank]
+        torch.set_rng_state(rank_state["rng"])
+        if rank_state["cuda_rng"]:
+            torch.cuda.set_rng_state_all(rank_state["cuda_rng"])
+
+    # assignments per expert of every layer since the last eval interval
+    expert_load = torch.zeros(n_layer, n_experts, dtype=torch.long, device=device)
+    train_losses, val_losses = [], []
+    try:
+        for iter in range(start_iter, max_iters):
+            # every once in a while evaluate the loss on train and val sets
+            is_eval_step = iter % eval_interval == 0 or iter == max_iters - 1
+            if context.is_main and is_eval_step:
+                capped = capacity_factor is not None or compile
+                if capped and iter > start_iter:
+                    # Drops of the last training step, read only at eval intervals.
+                    # compile caps expert capacity by default, see get_model
+                    metrics.log(
+                        {
+                            f"dropped_assignments/layer_{i}": dropped
+                            for i, dropped in enumerate(
+                                local_model.dropped_assignments()
+                            )
+                        },
+                        step=iter,
+                    )
+                if iter > start_iter:
+                    # Router statistics of the last training step and interval
+                    router_metrics = expert_load_metrics(expert_load)
+                    if load_balancing_coef or router_z_loss_coef:
+                        # only computed when they are added to the loss
+                        balancing_loss, z_loss = local_model.aux_loss_stats()
+                        router_metrics["load_balancing_loss"] = balancing_loss
+                        router_metrics["router_z_loss"] = z_loss
+                    metrics.log(router_metrics, step=iter)
+                    expert_load.zero_()
+                losses = evaluate_model(model=local_model, precision=precision)
+                print(
+                    f"step {iter}: "
+                    + ", ".join(f"{k} loss {v:.4f}" for k, v in losses.items())
+                )
+                metrics.log({f"{k}_loss": v for k, v in losses.items()}, step=iter)
+                val_losses.append(losses["val"])
 
-        # evaluate the loss
-        _, loss = model(xb, yb)
-        train_losses.append(loss.mean().item())
-        wandb.log({"train_loss": loss.mean().item()}, step=iter)  # type: ignore
+            # take the next prefetched batch of data
+            xb, yb = next(train_batches)
 
-        optimizer.zero_grad(set_to_none=True)
-        loss.mean().backward()
-        optimizer.step()
+            # evaluate the loss and update the model
+            step_start = time.perf_counter()
+            loss = train_step(
+                model,
+                optimizer,
+                scaler,
+                xb,
+                yb,
+                precision=precision,
+                grad_accum_steps=grad_accum_steps,
+            )
+            # Nothing syncs on the loss, so on CUDA this is the host time of the
+            # step, which follows the device once the launch queue is full
+            step_time = time.perf_counter() - step_start
+            train_losses.append(loss)
+            if context.is_main:
+                expert_load += local_model.expert_counts()
+                # train_loss of rank 0, tokens_per_sec of all ranks
+                tokens = batch_size * block_size * context.world_size
+                metrics.log(
+                    {
+                        "train_loss": loss,
+                        "data_wait_ms": train_batches.last_wait_time * 1e3,
+                        "step_time_ms": step_time * 1e3,
+                        "tokens_per_sec": tokens / step_time,
+                        "peak_memory_mb": peak_memory_mb(device),
+                    },
+                    step=iter,
+                )
 
-    return TrainerResults(model=model, train_losses=train_losses, val_losses=val_losses)
+            is_last_step = iter == max_iters - 1
+            if checkpoint_dir is not None and (
+                (iter + 1) % checkpoint_interval == 0 or is_last_step
+            ):
+                save_checkpoint(iter + 1)
+
+        if checkpoint_path is not None and context.is_main:
+            torch.save(unwrap_model(model).state_dict(), checkpoint_path)
+    finally:
+        if checkpoints is not None:
+            checkpoints.wait()
+        metrics.close()
+        for prefetcher in (train_batches, *eval_batches.values()):
+            prefetcher.close()
+        if distributed:
+            dist.destroy_process_group()
+    print(f"waited {train_batches.total_wait_time:.2f}s on training data")
+
+    return TrainerResults(
+        model=local_model,
+        train_losses=torch.stack(train_losses).tolist() if train_losses else [],
+        val_losses=val_losses,
+    )
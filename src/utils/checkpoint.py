@@ -0,0 +1,83 @@
+import glob
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import torch
+
+CHECKPOINT_PATTERN = "step_{step:08d}.pt"
+
+
+def to_cpu(state: Any) -> Any:
+    """A copy of a (nested) state dict with every tensor copied to the CPU"""
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+def list_checkpoints(directory: str) -> List[str]:
+    # the zero padded step keeps lexicographic order equal to step order
+    return sorted(glob.glob(os.path.join(directory, "step_*.pt")))
+
+
+def latest_checkpoint(path: str) -> Optional[str]:
+    """path itself if it is a checkpoint file, else the newest one in it"""
+    if os.path.isfile(path):
+        return path
+    checkpoints = list_checkpoints(path)
+    return checkpoints[-1] if checkpoints else None
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    """
+    Memory-maps the checkpoint, so tensors are only read from disk when they
+    are copied into the model and optimizer
+    """
+    return torch.load(path, map_location="cpu", mmap=True)
+
+
+class CheckpointManager:
+    """
+    Saves checkpoints to directory without blocking the training loop for the
+    write: save copies the state to the CPU and a background thread writes it
+    to a temporary file, renamed into place once complete, so a crash never
+    leaves a partial checkpoint behind. Only the last keep_last checkpoints
+    are kept.
+    """
+
+    def __init__(self, directory: str, keep_last: int = 3) -> None:
+        assert keep_last > 0, f"keep at least one checkpoint, got {keep_last=}"
+        self.directory = directory
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[Exception] = None
+
+    def save(self, step: int, state: Dict[str, Any]) -> None:
+        snapshot = to_cpu(state)
+        # one write in flight at a time bounds the CPU memory of snapshots
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(step, snapshot))
+        self._thread.start()
+
+    def _write(self, step: int, state: Dict[str, Any]) -> None:
+        try:
+            path = os.path.join(self.directory, CHECKPOINT_PATTERN.format(step=step))
+            torch.save(state, path + ".tmp")
+            os.replace(path + ".tmp", path)
+            for old in list_checkpoints(self.directory)[: -self.keep_last]:
+                os.remove(old)
+        except Exception as e:  # re-raised by the next wait
+            self._error = e
+
+    def wait(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
@@ -0,0 +1,52 @@
+import os
+from typing import NamedTuple
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+
+class DistributedContext(NamedTuple):
+    rank: int
+    local_rank: int
+    world_size: int
+
+    @property
+    def is_main(self) -> bool:
+        return self.rank == 0
+
+
+def init_distributed(backend: str = "gloo") -> DistributedContext:
+    """
+    Joins the process group described by the environment torchrun sets up
+    (RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT). gloo also runs
+    on CPU-only hosts, nccl needs one CUDA device per process.
+    """
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return DistributedContext(
+        rank=dist.get_rank(),
+        local_rank=int(os.environ.get("LOCAL_RANK", 0)),
+        world_size=dist.get_world_size(),
+    )
+
+
+def single_process() -> DistributedContext:
+    return DistributedContext(rank=0, local_rank=0, world_size=1)
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    """The model without its DistributedDataParallel and torch.compile wrappers"""
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    # torch.compile keeps the original module as _orig_mod
+    return getattr(model, "_orig_mod", model)
+
+
+def distributed_device(device: torch.device, local_rank: int) -> torch.device:
+    """One CUDA device per process on the node, CPU devices are shared"""
+    if device.type == "cuda":
+        torch.cuda.set_device(local_rank)
+        return torch.device("cuda", local_rank)
+    return device
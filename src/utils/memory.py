@@ -0,0 +1,14 @@
+import resource
+
+import torch
+
+
+def peak_memory_mb(device: torch.device) -> float:
+    """
+    Peak memory of the process so far: allocated CUDA memory on a CUDA device,
+    otherwise the resident set size of the process
+    """
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
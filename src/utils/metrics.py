@@ -0,0 +1,207 @@
+import csv
+import json
+import os
+import queue
+import sys
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+
+SINKS = ("wandb", "jsonl", "csv", "stdout")
+
+Metric = Union[torch.Tensor, float, int]
+
+
+class MetricSink(ABC):
+    @abstractmethod
+    def write(self, step: int, metrics: Dict[str, float]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class StdoutSink(MetricSink):
+    def write(self, step: int, metrics: Dict[str, float]) -> None:
+        values = ", ".join(f"{k} {v:.4g}" for k, v in metrics.items())
+        print(f"step {step}: {values}", file=sys.stdout)
+
+
+class JSONLSink(MetricSink):
+    """One JSON object per log call, with the step under "step" """
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, step: int, metrics: Dict[str, float]) -> None:
+        self.file.write(json.dumps({"step": step, **metrics}) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class CSVSink(MetricSink):
+    """
+    One step,metric,value row per metric, so steps may log different metrics
+    """
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "a", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file)
+        if is_new:
+            self.writer.writerow(["step", "metric", "value"])
+
+    def write(self, step: int, metrics: Dict[str, float]) -> None:
+        self.writer.writerows([step, k, v] for k, v in metrics.items())
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class WandbSink(MetricSink):
+    def __init__(self, **init_kwargs) -> None:
+        # Imported here, so runs that only log locally do not need wandb
+        import wandb
+
+        self.run = wandb.init(**init_kwargs)
+
+    def write(self, step: int, metrics: Dict[str, float]) -> None:
+        self.run.log(metrics, step=step)
+
+    def close(self) -> None:
+        self.run.finish()
+
+
+def make_sinks(
+    names: Sequence[str],
+    experiment_name: str,
+    experiment_group: str,
+    config: Dict,
+    project: str = "moe_9M",
+    log_dir: str = "logs",
+) -> List[MetricSink]:
+    sinks = []
+    for name in names:
+        assert name in SINKS, f"Unknown sink {name=} | Accepted values: {SINKS}"
+        if name == "wandb":
+            sinks.append(
+                WandbSink(
+                    project=project,
+                    name=experiment_name,
+                    group=experiment_group,
+                    config=config,
+                )
+            )
+        elif name == "jsonl":
+            sinks.append(JSONLSink(os.path.join(log_dir, f"{experiment_name}.jsonl")))
+        elif name == "csv":
+            sinks.append(CSVSink(os.path.join(log_dir, f"{experiment_name}.csv")))
+        else:
+            sinks.append(StdoutSink())
+    return sinks
+
+
+def _to_floats(tensors: List[torch.Tensor]) -> List[float]:
+    # One stacked copy per device instead of one sync per metric
+    by_device = defaultdict(list)
+    for i, tensor in enumerate(tensors):
+        by_device[tensor.device].append(i)
+    values = [0.0] * len(tensors)
+    for indices in by_device.values():
+        stacked = torch.stack([tensors[i].float().reshape(()) for i in indices])
+        for i, value in zip(indices, stacked.tolist()):
+            values[i] = value
+    return values
+
+
+class MetricsLogger:
+    """
+    Buffers metrics, keeping tensors on their device, and hands them to a
+    background thread every flush_every steps. Only that thread waits for the
+    tensors to be computed and writes them to the sinks, so logging never
+    syncs the training loop.
+    """
+
+    def __init__(self, sinks: Sequence[MetricSink], flush_every: int = 50) -> None:
+        self.sinks = list(sinks)
+        self.flush_every = flush_every
+        self._buffer: List[Tuple[int, Dict[str, Metric]]] = []
+        self._buffered_steps = 0
+        self._error: Optional[Exception] = None
+
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def log(self, metrics: Dict[str, Metric], step: int) -> None:
+        if not self.sinks:
+            return
+        if not self._buffer or self._buffer[-1][0] != step:
+            self._buffered_steps += 1
+        self._buffer.append(
+            (
+                step,
+                {
+                    k: v.detach() if isinstance(v, torch.Tensor) else v
+                    for k, v in metrics.items()
+                },
+            )
+        )
+        if self._buffered_steps >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._error is not None:
+            raise self._error
+        if self._buffer:
+            self._queue.put(self._buffer)
+        self._buffer, self._buffered_steps = [], 0
+
+    def _worker(self) -> None:
+        while True:
+            entries = self._queue.get()
+            if entries is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._write(entries)
+            except Exception as e:  # re-raised by the next flush
+                self._error = e
+
+    def _write(self, entries: List[Tuple[int, Dict[str, Metric]]]) -> None:
+        tensors = [
+            v for _, metrics in entries for v in metrics.values() if torch.is_tensor(v)
+        ]
+        values = iter(_to_floats(tensors))
+        for step, metrics in entries:
+            metrics = {
+                k: next(values) if torch.is_tensor(v) else v for k, v in metrics.items()
+            }
+            for sink in self.sinks:
+                sink.write(step, metrics)
+
+    def close(self) -> None:
+        if self._buffer:
+            self._queue.put(self._buffer)
+        self._buffer, self._buffered_steps = [], 0
+        self._queue.put(None)
+        self._thread.join()
+        for sink in self.sinks:
+            sink.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self) -> "MetricsLogger":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
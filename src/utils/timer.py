@@ -1,16 +1,22 @@
 class TimerContextManager:
-    def __init__(self):
+    def __init__(self, verbose: bool = True):
         self.start_time = None
         self.end_time = None
+        self.verbose = verbose
+
+    @property
+    def elapsed(self) -> float:
+        return self.end_time - self.start_time
 
     def __enter__(self):
         import time
 
-        self.start_time = time.time()
+        self.start_time = time.perf_counter()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         import time
 
-        self.end_time = time.time()
-        print(f"Time taken: {self.end_time - self.start_time} seconds")
+        self.end_time = time.perf_counter()
+        if self.verbose:
+            print(f"Time taken: {self.elapsed} seconds")
@@ -0,0 +1,27 @@
+import torch
+import torch._dynamo
+
+from src.model.moe import SparseMoE
+from src.model.routers import NoisyTopKRouter
+from src.train import get_model
+
+CONFIG = dict(n_embed=32, n_head=4, n_layer=2, num_experts=4, top_k=2, block_size=16)
+
+
+def test_compile_config_has_no_graph_breaks() -> None:
+    # The static-shape configuration get_model(compile=True) builds
+    model = get_model(
+        vocab_size=65,
+        router_class=NoisyTopKRouter,
+        dispatch="padded",
+        stacked_experts=True,
+        capacity_factor=SparseMoE.no_drop_capacity_factor(
+            CONFIG["num_experts"], CONFIG["top_k"]
+        ),
+        **CONFIG,
+    )
+    idx = torch.randint(65, (2, CONFIG["block_size"]))
+
+    torch._dynamo.reset()
+    explanation = torch._dynamo.explain(model)(idx, idx)
+    assert explanation.graph_break_count == 0, explanation.break_reasons
@@ -0,0 +1,74 @@
+import pytest
+import torch
+
+from src.inference.engine import GenerationEngine, GenerationRequest
+from src.model.routers import ExpertChoiceRouter, NoisyTopKRouter
+from src.model.transformer import SparseMoELanguageModel
+
+CONFIG = dict(n_embed=32, n_head=4, n_layer=2, num_experts=4, block_size=16)
+
+
+def prefill_keys(model: SparseMoELanguageModel, prompts) -> torch.Tensor:
+    """Cached keys of the first prompt after the engine admitted all of them"""
+    engine = GenerationEngine(model, CONFIG["block_size"], max_batch_size=4)
+    for prompt in prompts:
+        engine.submit(GenerationRequest(prompt=prompt, max_new_tokens=4))
+    engine.step()
+    return engine.kv_cache.keys[:, 0, :, : len(prompts[0])].clone()
+
+
+@pytest.mark.parametrize(
+    "router_class, capacity_factor",
+    [(NoisyTopKRouter, 1.0), (ExpertChoiceRouter, None)],
+)
+def test_batched_prefill_matches_solo_prefill(router_class, capacity_factor):
+    torch.manual_seed(0)
+    model = SparseMoELanguageModel(
+        vocab_size=65,
+        top_k=2,
+        router_class=router_class,
+        dispatch="padded",
+        capacity_factor=capacity_factor,
+        **CONFIG,
+    )
+    short, long = [1, 2, 3], list(range(10, 22))
+    torch.testing.assert_close(
+        prefill_keys(model, [short, long]), prefill_keys(model, [short])
+    )
+
+
+@pytest.mark.parametrize("dispatch", ["loop", "sorted", "padded"])
+def test_engine_matches_cached_generate(dispatch: str, monkeypatch) -> None:
+    # Greedy sampling in both, so the batch a sequence decodes in cannot
+    # change which random numbers it draws
+    def greedy(probs: torch.Tensor, num_samples: int) -> torch.Tensor:
+        return probs.argmax(dim=-1, keepdim=True)
+
+    monkeypatch.setattr(torch, "multinomial", greedy)
+    torch.manual_seed(0)
+    model = SparseMoELanguageModel(
+        vocab_size=65,
+        top_k=2,
+        router_class=NoisyTopKRouter,
+        dispatch=dispatch,
+        **CONFIG,
+    ).eval()
+    requests = [
+        GenerationRequest(prompt=[1, 2, 3], max_new_tokens=6),
+        GenerationRequest(prompt=list(range(10, 22)), max_new_tokens=4),
+        GenerationRequest(prompt=[5, 8, 13, 21, 34], max_new_tokens=2),
+    ]
+    engine = GenerationEngine(model, CONFIG["block_size"], max_batch_size=2)
+    for request in requests:
+        engine.submit(request)
+    results = engine.run().results
+
+    for request, result in zip(requests, results):
+        with torch.no_grad():
+            idx = model.generate(
+                torch.tensor([request.prompt]),
+                request.max_new_tokens,
+                CONFIG["block_size"],
+                use_cache=True,
+            )
+        assert result.tokens == idx[0, len(request.prompt) :].tolist()
@@ -0,0 +1,63 @@
+import copy
+
+import pytest
+import torch
+
+from src.model.moe import DispatchPlanCache
+from src.model.routers import ROUTERS
+from src.model.transformer import SparseMoELanguageModel
+
+CONFIG = dict(n_embed=32, n_head=4, n_layer=2, num_experts=4, block_size=16)
+
+
+@pytest.mark.parametrize("router", list(ROUTERS))
+def test_deepcopy_after_training_forward(router: str) -> None:
+    torch.manual_seed(0)
+    model = SparseMoELanguageModel(
+        vocab_size=65,
+        top_k=2,
+        router_class=ROUTERS[router],
+        dispatch="sorted",
+        load_balancing_coef=0.01,
+        router_z_loss_coef=0.001,
+        **CONFIG,
+    )
+    idx = torch.randint(65, (2, CONFIG["block_size"]))
+    _, loss = model(idx, idx)
+    loss.backward()
+
+    load_balancing_loss, router_z_loss = model.aux_loss_stats()
+    assert not load_balancing_loss.requires_grad and not router_z_loss.requires_grad
+    # nothing on the modules holds on to the autograd graph of the forward
+    copy.deepcopy(model)
+
+
+def test_dispatch_plan_cache_keys_and_bound() -> None:
+    torch.manual_seed(0)
+    model = SparseMoELanguageModel(
+        vocab_size=65,
+        top_k=2,
+        router_class=ROUTERS["noisy_top_k"],
+        dispatch="sorted",
+        **CONFIG,
+    ).eval()
+    batches = torch.randint(65, (3, 2, CONFIG["block_size"]))
+    cache = DispatchPlanCache(max_batches=2)
+    with torch.no_grad(), model.dispatch_plan_cache(cache):
+        expected = model(batches[0], batches[0], plan_id=0)[1]
+        assert torch.equal(model(batches[0], batches[0], plan_id=0)[1], expected)
+        # calls without a plan_id are not cached
+        model(batches[1], batches[1])
+        assert all(len(layer) == 1 for layer in cache.layers.values())
+
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            model(batches[0], batches[0], plan_id=0)
+        assert all(len(layer) == 2 for layer in cache.layers.values())
+
+        for i, batch in enumerate(batches):
+            model(batch, batch, plan_id=i)
+        # only the two most recent batches are kept
+        assert all(len(layer) == 2 for layer in cache.layers.values())
+        assert all(
+            [key[0] for key in layer] == [1, 2] for layer in cache.layers.values()
+        )
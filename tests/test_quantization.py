@@ -0,0 +1,20 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from src.model.quantization import Int8Linear, dynamic_quantization_available
+
+
+@pytest.mark.skipif(not dynamic_quantization_available(), reason="no quantized engine")
+def test_int8_linear_repacks_after_apply() -> None:
+    torch.manual_seed(0)
+    linear = nn.Linear(16, 8)
+    layer = Int8Linear.from_linear(linear)
+    x = torch.randn(4, 16)
+    expected = layer(x)
+    assert layer._packed is not None
+
+    layer.to("cpu")
+    assert layer._packed is None
+    torch.testing.assert_close(layer(x), expected)
+    torch.testing.assert_close(expected, linear(x), rtol=0.05, atol=0.05)
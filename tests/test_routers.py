@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from src.model.moe import Router
+from src.model.routers import (
+    ExpertChoiceRouter,
+    FusedTopKRouter,
+    HashRouter,
+    NoisyTopKRouter,
+)
+
+
+@pytest.mark.parametrize("num_experts", [4, 8, 16])
+def test_hash_router_is_not_modulo(num_experts: int) -> None:
+    router = HashRouter(n_embed=8, num_experts=num_experts, top_k=2)
+    token_ids = torch.arange(65).unsqueeze(0)
+    weights, indices, logits = router(torch.zeros(1, 65, 8), token_ids)
+
+    first_expert = indices[..., 0]
+    assert not torch.equal(first_expert, token_ids % num_experts)
+    # every expert still gets some of the vocabulary
+    assert first_expert.unique().numel() == num_experts
+    assert torch.equal(indices[..., 1], (first_expert + 1) % num_experts)
+    assert torch.allclose(weights, torch.full_like(weights, 0.5))
+    assert logits is None
+
+
+@pytest.mark.parametrize(
+    "router_class", [NoisyTopKRouter, FusedTopKRouter, ExpertChoiceRouter]
+)
+def test_router_routes_in_fp32_under_autocast(router_class: Router) -> None:
+    torch.manual_seed(0)
+    router = router_class(n_embed=32, num_experts=8, top_k=2).eval()
+    # bf16 hidden states, as the attention block returns them under autocast
+    x = torch.randn(2, 16, 32).bfloat16()
+    with torch.no_grad():
+        expected = router(x.float())
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            output = router(x)
+    assert all(t.dtype != torch.bfloat16 for t in output if t is not None)
+    torch.testing.assert_close(output, expected)
+
+
+@pytest.mark.parametrize("router_class", [NoisyTopKRouter, FusedTopKRouter])
+def test_router_returns_logits_without_noise(router_class: Router) -> None:
+    torch.manual_seed(0)
+    router = router_class(n_embed=32, num_experts=8, top_k=2).train()
+    x = torch.randn(2, 16, 32)
+    with torch.no_grad():
+        _, _, train_logits = router(x)
+        _, _, eval_logits = router.eval()(x)
+    # the noise only moves the top-k choice, not the logits of the aux losses
+    torch.testing.assert_close(train_logits, eval_logits)
@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from src.model.routers import NoisyTopKRouter
+from src.model.transformer import SparseMoELanguageModel
+
+CONFIG = dict(n_embed=32, n_head=4, n_layer=2, num_experts=4, block_size=16)
+
+
+@pytest.mark.parametrize("fused_attention", [False, True])
+def test_cached_generate_under_autocast(fused_attention: bool) -> None:
+    torch.manual_seed(0)
+    model = SparseMoELanguageModel(
+        vocab_size=65,
+        top_k=2,
+        router_class=NoisyTopKRouter,
+        fused_attention=fused_attention,
+        **CONFIG,
+    ).eval()
+    prompt = torch.randint(65, (2, 4))
+    with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+        idx = model.generate(prompt, 6, CONFIG["block_size"], use_cache=True)
+    assert idx.shape == (2, 10)
+    assert torch.equal(idx[:, :4], prompt)